@@ -0,0 +1,237 @@
+#!/usr/bin/python
+"""
+Times the game's hot paths without a display, and compares the results of two runs.
+
+    python benchmark.py run [-o results.json] [--sizes 20,40] [--agents 10,40,80]
+    python benchmark.py compare old.json new.json [--threshold 0.1]
+"""
+
+import argparse, json, os, platform, random, shutil, sys, tempfile, time, timeit
+from StringIO import StringIO
+
+os.environ["SDL_VIDEODRIVER"] = "dummy"
+os.environ["SDL_AUDIODRIVER"] = "dummy"
+
+import pygame
+from wanderer import agents, game, timers, world
+from wanderer.constants import *
+
+SEED = 1                # every case starts from the same random state
+MAP_UPDATES = 200       # steady-state Map.update calls per measurement
+WALK_STEPS = 100        # steps per NPC per measurement
+RENDER_FRAMES = 50      # full-screen redraws per measurement
+TIMER_COUNT = 10000     # timers created per churn measurement
+
+
+def fresh_game(size = game.MAP_SIZE):
+    "Return a headless game.Game with a new map and no timers left over from other cases."
+    timers.scheduler = timers.Scheduler()
+    random.seed(SEED)
+    new_game = game.Game(headless = True)
+    new_game.new(size)
+    return new_game
+
+def quietly(function, *args):
+    "Call function without letting it print anything."
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        return function(*args)
+    finally:
+        sys.stdout = stdout
+
+
+# Each benchmark takes its parameter, does any setup, and returns a
+# function which performs the operation being timed.
+
+def bench_tier_build(size):
+    "Build a default world.Tier."
+    fresh_game()
+    return lambda: world.Tier(pygame.Rect(0, 0, size, size))
+
+def bench_set_rect(size):
+    "Fill a whole layer with Layer.set_rect."
+    fresh_game()
+    rect = pygame.Rect(0, 0, size, size)
+    return lambda: world.Layer(rect).set_rect((0, 0), (size, size), world.GrassTile)
+
+def bench_array_set_rect(size):
+    "Fill a whole world.ArrayLayer with Layer.set_rect."
+    fresh_game()
+    rect = pygame.Rect(0, 0, size, size)
+    return lambda: world.ArrayLayer(rect).set_rect((0, 0), (size, size), world.GrassTile)
+
+def bench_map_update(size):
+    "Call Map.update repeatedly on a map with no edits."
+    fresh_game()
+    world_map = world.Map(pygame.Rect(0, 0, size, size))
+    for i in xrange(5):
+        world_map.update()
+    def run():
+        for i in xrange(MAP_UPDATES):
+            world_map.update()
+    return run
+
+def bench_render(size):
+    "Redraw the whole screen, with the camera following the player around a map."
+    current_game = fresh_game(size)
+    for i in xrange(10):
+        agents.Npc(current_game)
+    current_game.loop()
+    def run():
+        for i in xrange(RENDER_FRAMES):
+            current_game.player.sprite.rect.move_ip(7, 5)
+            current_game.map.dirty_rects.append(current_game.screen.get_rect())
+            current_game.render()
+    return run
+
+def bench_agent_walk(npcs):
+    "Walk every NPC around with collision checks."
+    current_game = fresh_game()
+    for i in xrange(npcs):
+        agents.Npc(current_game)
+    directions = [UP, DOWN, LEFT, RIGHT]
+    def run():
+        for step in xrange(WALK_STEPS):
+            for npc in current_game.all_npcs:
+                if not npc.walk(npc.direction or DOWN):
+                    npc.direction = random.choice(directions)
+    return run
+
+def bench_timer_churn(count):
+    "Create timers, cancel half of them, and run the rest out."
+    fresh_game()
+    def noop():
+        pass
+    def run():
+        scheduled = [timers.Timer(random.randint(0, 1000), noop) for i in xrange(count)]
+        for timer in scheduled[::2]:
+            timer.cancel()
+        for i in xrange(41):
+            timers.scheduler.update(game.TICK_LENGTH)
+    return run
+
+def bench_save_load(size):
+    "Save the game and load it again."
+    current_game = fresh_game()
+    current_game.map = world.Map(pygame.Rect(0, 0, size, size))
+    def run():
+        quietly(current_game.save)
+        quietly(current_game.load)
+    return run
+
+BENCHMARKS = [
+    ("tier_build", "size", bench_tier_build),
+    ("set_rect", "size", bench_set_rect),
+    ("array_set_rect", "size", bench_array_set_rect),
+    ("map_update", "size", bench_map_update),
+    ("render", "size", bench_render),
+    ("agent_walk", "npcs", bench_agent_walk),
+    ("timer_churn", "timers", bench_timer_churn),
+    ("save_load", "size", bench_save_load),
+]
+
+
+def measure(setup, value, repeat):
+    "Time repeat runs of one benchmark, each with its own setup; returns a list of seconds."
+    times = []
+    for i in xrange(repeat):
+        run = setup(value)
+        start = timeit.default_timer()
+        run()
+        times.append(timeit.default_timer() - start)
+    return times
+
+def run_benchmarks(options):
+    "Run every benchmark over its parameter sweep and write the results as JSON."
+    sweeps = {"size": options.sizes, "npcs": options.agents, "timers": [TIMER_COUNT]}
+    results = []
+    workdir = tempfile.mkdtemp(prefix = "wanderer-bench-")
+    # save_load writes the savefile into the current directory
+    olddir = os.getcwd()
+    os.chdir(workdir)
+    try:
+        for name, parameter, setup in BENCHMARKS:
+            if options.only and name not in options.only:
+                continue
+            for value in sweeps[parameter]:
+                times = sorted(measure(setup, value, options.repeat))
+                result = {"name": name, "params": {parameter: value}, "times": times,
+                          "best": times[0], "median": times[len(times)/2]}
+                results.append(result)
+                print "{:<14} {:>7}={:<6} best {:.4f}s  median {:.4f}s".format(name, parameter, value, result["best"], result["median"])
+    finally:
+        os.chdir(olddir)
+        shutil.rmtree(workdir)
+
+    report = {"meta": {"time": time.time(),
+                       "python": platform.python_version(),
+                       "pygame": pygame.version.ver,
+                       "platform": platform.platform(),
+                       "repeat": options.repeat},
+              "results": results}
+    output = open(options.output, "w")
+    json.dump(report, output, sort_keys = True, indent = 4)
+    output.close()
+    print "Results written to {}.".format(options.output)
+
+def compare_results(options):
+    "Compare median times between two result files; exits with status 1 if anything regressed."
+    def keyed(filename):
+        f = open(filename)
+        report = json.load(f)
+        f.close()
+        return dict(((r["name"], tuple(sorted(r["params"].items()))), r) for r in report["results"])
+    old, new = (keyed(options.old), keyed(options.new))
+    regressions = 0
+    for key in sorted(set(old) & set(new)):
+        name, params = key
+        ratio = new[key]["median"] / old[key]["median"]
+        if ratio > 1 + options.threshold:
+            verdict = "REGRESSED"
+            regressions += 1
+        elif ratio < 1 - options.threshold:
+            verdict = "improved"
+        else:
+            verdict = ""
+        label = "{} {}".format(name, " ".join("{}={}".format(k, v) for k, v in params))
+        print "{:<28} {:.4f}s -> {:.4f}s  x{:.2f}  {}".format(label, old[key]["median"], new[key]["median"], ratio, verdict)
+    for key in sorted(set(old) ^ set(new)):
+        print "{} only in one run, skipped".format(key[0])
+    if regressions:
+        print "{} regression(s) beyond {:.0%}.".format(regressions, options.threshold)
+        sys.exit(1)
+    print "No regressions beyond {:.0%}.".format(options.threshold)
+
+
+def int_list(text):
+    return [int(value) for value in text.split(",")]
+
+parser = argparse.ArgumentParser(description = "Benchmark the game's hot paths.")
+subparsers = parser.add_subparsers()
+
+run_parser = subparsers.add_parser("run", help = "run the benchmarks")
+run_parser.add_argument("-o", "--output", default = "benchmark.json",
+    help = "where to write the JSON results (default: %(default)s)")
+run_parser.add_argument("--sizes", type = int_list, default = [20, 40],
+    help = "comma-separated map sizes in tiles (default: 20,40)")
+run_parser.add_argument("--agents", type = int_list, default = [10, 40, 80],
+    help = "comma-separated NPC counts (default: 10,40,80)")
+run_parser.add_argument("--repeat", type = int, default = 5,
+    help = "runs of each case; the median is compared (default: %(default)s)")
+run_parser.add_argument("--only", action = "append",
+    help = "only run the named benchmark (may be repeated)")
+run_parser.set_defaults(action = run_benchmarks)
+
+compare_parser = subparsers.add_parser("compare", help = "compare two sets of results")
+compare_parser.add_argument("old")
+compare_parser.add_argument("new")
+compare_parser.add_argument("--threshold", type = float, default = 0.1,
+    help = "fractional slowdown which counts as a regression (default: %(default)s)")
+compare_parser.set_defaults(action = compare_results)
+
+if __name__ == "__main__":
+    pygame.init()
+    options = parser.parse_args()
+    options.action(options)
+    pygame.quit()
@@ -0,0 +1,115 @@
+#!/usr/bin/python
+"""
+Packs the tile sheets used by the game's tile types into one or a few atlas images, with an index of where each tile image is on them, for world.Tileset to slice from. The game goes back to a sheet's own file if it's changed since it was packed, until this is run again; the binary build scripts run it first.
+
+    python build_atlas.py [--max-size 1024] [name ...]
+"""
+
+import argparse, json, os
+
+os.environ["SDL_VIDEODRIVER"] = "dummy"
+os.environ["SDL_AUDIODRIVER"] = "dummy"
+
+import pygame
+from wanderer import world
+from wanderer.constants import *
+
+MAX_SIZE = 1024     # pixels along each side of an atlas image
+PAGE_NAME = "tiles-{}.png"  # atlas image filenames, numbered from 0
+
+
+def tile_names():
+    "Return the sheet names used by world's tile classes, i.e. those which name their own sheet."
+    names = set()
+    classes = [world.Tile]
+    while classes:
+        tile_class = classes.pop()
+        classes.extend(tile_class.__subclasses__())
+        try:
+            names.add(tile_class().name)
+        except TypeError:
+            # needs to be told which sheet to use
+            pass
+    return sorted(names)
+
+def pack(sizes, max_size = MAX_SIZE):
+    """
+    Arrange rects of the given sizes, a dict of names to (width, height), on as few pages of at most max_size pixels square as they'll fit. Returns a list of dicts of names to pygame.Rects, one per page.
+
+    They're put in rows, tallest first, which suits sheets which are mostly the same size.
+    """
+    pages = []
+    x = row_top = row_height = 0
+    for name in sorted(sizes, key = lambda name: (-sizes[name][1], name)):
+        width, height = sizes[name]
+        if width > max_size or height > max_size:
+            raise ValueError("{} ({}x{}) is bigger than an atlas image".format(name, width, height))
+        if x + width > max_size:
+            # start a new row
+            x, row_top, row_height = (0, row_top + row_height, 0)
+        if not pages or row_top + height > max_size:
+            pages.append({})
+            x = row_top = row_height = 0
+        pages[-1][name] = pygame.Rect(x, row_top, width, height)
+        x += width
+        row_height = max(row_height, height)
+    return pages
+
+def build(names, max_size = MAX_SIZE):
+    "Pack the named tile sheets into atlas images in world.ATLAS_DIR, replacing any already there, and write their index."
+    sheets = {}
+    mtimes = {}
+    # so the game can tell if a sheet changes after it's packed
+    for name in names:
+        path = os.path.join(DATA_DIR, "images", "tiles", name + ".png")
+        mtimes[name] = os.path.getmtime(path)
+        sheet = pygame.image.load(path).convert_alpha()
+        variant_rects, health_rects = world.sheet_rects()
+        if not all(sheet.get_rect().contains(rect) for rect in variant_rects.values() + filter(None, health_rects)):
+            raise ValueError("{} isn't laid out as a tile sheet".format(name))
+        sheets[name] = sheet
+
+    if not os.path.isdir(world.ATLAS_DIR):
+        os.makedirs(world.ATLAS_DIR)
+    for filename in os.listdir(world.ATLAS_DIR):
+        if filename == world.ATLAS_INDEX or filename.endswith(".png"):
+            os.remove(os.path.join(world.ATLAS_DIR, filename))
+
+    index = {"version": world.ATLAS_VERSION, "tile_size": world.TILE_SIZE, "sheets": {}}
+    pages = pack(dict((name, sheet.get_size()) for name, sheet in sheets.items()), max_size)
+    for number, rects in enumerate(pages):
+        filename = PAGE_NAME.format(number)
+        size = (max(rect.right for rect in rects.values()), max(rect.bottom for rect in rects.values()))
+        page = pygame.Surface(size, pygame.SRCALPHA, 32)
+        page.fill((0, 0, 0, 0))
+        for name, rect in sorted(rects.items()):
+            page.blit(sheets[name], rect, special_flags = pygame.BLEND_RGBA_MAX)
+            # copies the sheet's pixels as they are, where a normal blit
+            # would blend them onto the empty page
+            variant_rects, health_rects = world.sheet_rects(rect.left, rect.top)
+            index["sheets"][name] = {"image": filename, "rect": tuple(rect), "mtime": mtimes[name],
+                                     "variants": dict((mask, tuple(r)) for mask, r in variant_rects.items()),
+                                     "health": [r and tuple(r) for r in health_rects]}
+        pygame.image.save(page, os.path.join(world.ATLAS_DIR, filename))
+        print "{}: {}x{}, {}".format(filename, size[0], size[1], ", ".join(sorted(rects)))
+
+    # written last, so the game never finds an index without its images
+    index_file = open(os.path.join(world.ATLAS_DIR, world.ATLAS_INDEX), "w")
+    json.dump(index, index_file, sort_keys = True)
+    index_file.close()
+    print "Packed {} tile sheets into {} atlas image(s).".format(len(sheets), len(pages))
+
+
+parser = argparse.ArgumentParser(description = "Pack tile sheets into atlas images.")
+parser.add_argument("names", nargs = "*",
+    help = "sheets to pack, by base name (default: the ones the tile types use)")
+parser.add_argument("--max-size", type = int, default = MAX_SIZE,
+    help = "most pixels along each side of an atlas image (default: %(default)s)")
+
+if __name__ == "__main__":
+    pygame.init()
+    options = parser.parse_args()
+    pygame.display.set_mode((1, 1), 0, 32)
+    # convert_alpha() needs a display mode
+    build(options.names or tile_names(), options.max_size)
+    pygame.quit()
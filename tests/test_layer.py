@@ -0,0 +1,75 @@
+"""
+Checks of Layer autotiling. Run from the top directory with:
+
+    python -m unittest discover tests
+"""
+
+import os, unittest
+
+os.environ["SDL_VIDEODRIVER"] = "dummy"
+os.environ["SDL_AUDIODRIVER"] = "dummy"
+
+import pygame
+from wanderer import world
+
+
+class UnsettledLayer(world.Layer):
+    "A Layer which never skips updating a changed tile's neighbors, as it was before edits were batched."
+
+    def update(self):
+        self.settled.clear()
+        super(UnsettledLayer, self).update()
+
+
+class UnsettledArrayLayer(world.ArrayLayer):
+    "An ArrayLayer which never skips updating a changed tile's neighbors."
+
+    def update(self):
+        self.settled.clear()
+        super(UnsettledArrayLayer, self).update()
+
+
+def remove_and_replace(layer_class):
+    "Return a layer in which a tile next to another was removed and put back again before an update."
+    layer = layer_class(pygame.Rect(0, 0, 8, 8))
+    layer.set_tile(4, 4, world.GrassTile(health = 4))
+    layer.set_tile(3, 4, None)
+    layer.set_tile(3, 4, world.GrassTile(health = 3))
+    layer.update()
+    layer.update()
+    return layer
+
+def bitmasks(layer, left, top, right, bottom):
+    "Return rows of the bitmasks in an area of a layer, with None for empty locations."
+    rows = []
+    for y in xrange(top, bottom):
+        row = []
+        for x in xrange(left, right):
+            tile = layer.get_tile(x, y)
+            row.append(tile.bitmask if tile else None)
+        rows.append(row)
+    return rows
+
+
+class SettledTileTest(unittest.TestCase):
+
+    def setUp(self):
+        pygame.init()
+        pygame.display.set_mode((64, 64), 0, 32)
+
+    def tearDown(self):
+        pygame.quit()
+
+    def test_remove_and_replace(self):
+        expected = [[0b0001, 0b0011, 0b0011, 0b0010],
+                    [0b0101, 0b1111, 0b1111, 0b1010],
+                    [0b0100, 0b1100, 0b1100, 0b1000]]
+        for layer_class, unsettled_class in ((world.Layer, UnsettledLayer), (world.ArrayLayer, UnsettledArrayLayer)):
+            layer = remove_and_replace(layer_class)
+            unsettled = remove_and_replace(unsettled_class)
+            self.assertEqual(bitmasks(layer, 0, 0, 8, 8), bitmasks(unsettled, 0, 0, 8, 8))
+            self.assertEqual(bitmasks(layer, 2, 3, 6, 6), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,3 +1,3 @@
 #!/bin/bash 
 
-python -O /home/fizz/pyinstaller-2.0/pyinstaller.py wanderer.linuxmac.spec && mv wanderer-linux binaries
+python build_atlas.py && python -O /home/fizz/pyinstaller-2.0/pyinstaller.py wanderer.linuxmac.spec && mv wanderer-linux binaries
@@ -1,3 +1,3 @@
 #!/bin/bash 
 
-wine C:/Python27/python.exe -O $(winepath -w /home/fizz/pyinstaller-2.0/pyinstaller.py) --noupx wanderer.windows.spec && mv wanderer-windows.exe binaries
+wine C:/Python27/python.exe build_atlas.py && wine C:/Python27/python.exe -O $(winepath -w /home/fizz/pyinstaller-2.0/pyinstaller.py) --noupx wanderer.windows.spec && mv wanderer-windows.exe binaries
@@ -1,23 +1,96 @@
 #!/usr/bin/python
 
+import timeit
+launched = timeit.default_timer()
+# as early as we can, for --startup-report
+
+import argparse, os, time
+
+parser = argparse.ArgumentParser(description="A pygame learning project.")
+parser.add_argument("--headless", action="store_true",
+    help="run the simulation without a display or input, then report its speed (doesn't touch the savefile)")
+parser.add_argument("--ticks", type=int, default=1000,
+    help="with --headless, how many ticks to run (default: %(default)s)")
+parser.add_argument("--npcs", type=int, default=0,
+    help="with --headless, how many NPCs to create (default: %(default)s)")
+parser.add_argument("--fps", type=int, default=None,
+    help="most frames to draw per second, or 0 for no limit (default: 40); the game runs at the same speed regardless")
+parser.add_argument("--profile-csv", metavar="FILE",
+    help="write how long each phase of each frame took to a CSV file")
+parser.add_argument("--map-size", type=int, default=None,
+    help="start a new game on a generated map this many tiles along each side (default: 20)")
+parser.add_argument("--map", metavar="FILE",
+    help="start a new game on a map made with Tiled, e.g. wanderer/data/maps/island.tmx")
+parser.add_argument("--startup-report", action="store_true",
+    help="print how long each step of starting up took, up to the first frame")
+options = parser.parse_args()
+
+if options.headless:
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    os.environ["SDL_AUDIODRIVER"] = "dummy"
+
 import pygame
-from wanderer import game
+pygame_imported = timeit.default_timer()
+from wanderer import game, agents, profiler
+startup = profiler.StartupTimer(launched)
+startup.mark("import pygame", pygame_imported)
+startup.mark("import wanderer")
+
+frame_rate = game.FRAME_RATE
+if options.fps is not None:
+    frame_rate = options.fps
+map_size = options.map_size or game.MAP_SIZE
 
 pygame.init()
+startup.mark("pygame.init")
 
-print "Welcome! Initializing game ..."
-game = game.Game()
-try:
-    game.load()
-except IOError:
-    print "No savefile found or not readable, starting new game."
-    game.new()
-game.init_controls()
-game.confirm_start()
-
-while not game.finished:
+def first_frame():
+    "Run the first frame, and report how long it took to get there if asked to."
     game.loop()
+    startup.mark("first frame")
+    if options.startup_report:
+        print startup.report()
+
+if options.headless:
+    game = game.Game(headless = True, profile_csv = options.profile_csv, startup = startup)
+    game.new(map_size, options.map)
+    startup.mark("map")
+    game.init_controls()
+    startup.mark("controls")
+    for i in xrange(options.npcs):
+        agents.Npc(game)
+    print "Running {} ticks with {} NPCs ...".format(options.ticks, options.npcs)
+    start = time.time()
+    first_frame()
+    for i in xrange(options.ticks - 1):
+        game.loop()
+    elapsed = time.time() - start
+    print "{} ticks in {:.2f}s: {:.1f} ticks per second.".format(options.ticks, elapsed, options.ticks / elapsed)
+    game.profiler.close()
+else:
+    print "Welcome! Initializing game ..."
+    game = game.Game(frame_rate = frame_rate, profile_csv = options.profile_csv, startup = startup)
+    if options.map or options.map_size is not None:
+        # asked for a new map, so don't pick up the saved one
+        print "Starting new game."
+        game.new(map_size, options.map)
+    else:
+        try:
+            game.load()
+        except IOError:
+            print "No savefile found or not readable, starting new game."
+            game.new(map_size, options.map)
+    startup.mark("map")
+    game.init_controls()
+    startup.mark("controls")
+    game.confirm_start()
+    if not game.finished:
+        first_frame()
+
+    while not game.finished:
+        game.loop()
 
 pygame.quit()
 # ^ not usually necessary, but some interpreters hang without it
-print "Goodbye!"
+if not options.headless:
+    print "Goodbye!"
@@ -9,6 +9,8 @@ class Agent(object):
         name            (optional: string to call this agent)
         spriteno        (optional: which # sprite to use, defaults to random)
         location        (optional: (x, y) location to center sprite on)
+
+    Locations are in map pixel coordinates; the game's camera works out where they are on the screen.
     """
 
     INTERJECT_TIMEOUT = 500     # milliseconds
@@ -30,7 +32,8 @@ class Agent(object):
         self.last_greetings = [None for x in xrange(5)]
         self.interject_ok = True
 
-        self.area = game.screen.get_rect()
+        self.area = game.map.px_rect
+        # agents can't walk off the edge of the map
         if spriteno:
             self.spriteno = spriteno
         else:
@@ -57,23 +60,24 @@ class Agent(object):
         charx = column * self.CHAR_WIDTH
         chary = row * self.CHAR_HEIGHT
         char_cursor = pygame.Rect(charx, chary, self.CHAR_WIDTH, self.CHAR_HEIGHT)
-        sprite_sheet = pygame.image.load(self.game.sprites).convert()
-        char_sheet = sprite_sheet.subsurface(char_cursor)
+        animations = sprites.get_animations(self.game.sprites, char_cursor)
         if hasattr(self, "sprite"):
             if not location:
                 location = self.sprite.rect
             direction = self.sprite.direction
             self.sprite.kill()
-            self.sprite = sprites.Character(self, char_sheet, location, direction)
+            self.sprite = sprites.Character(self, animations, location, direction)
         elif not location:
             old_iok = self.interject_ok
             self.interject_ok = False
             # To keep agents from responding to collisions while testing locations
+            spawn_area = self.game.map.view.clip(self.area)
+            # new agents appear somewhere in view
             while True:
-                locx = random.randrange(0, self.area.width - SPRITE_WIDTH)
-                locy = random.randrange(0, self.area.height - SPRITE_HEIGHT)
+                locx = random.randrange(spawn_area.left, spawn_area.right - SPRITE_WIDTH)
+                locy = random.randrange(spawn_area.top, spawn_area.bottom - SPRITE_HEIGHT)
                 location = pygame.Rect(locx, locy, SPRITE_WIDTH, SPRITE_HEIGHT)
-                self.sprite = sprites.Character(self, char_sheet, location)
+                self.sprite = sprites.Character(self, animations, location)
                 if not self.colliding():
                     break
                 else:
@@ -108,12 +112,13 @@ class Agent(object):
 
     def colliding_sprites(self):
         "Returns list of sprites this agent is currently colliding with."
-        all_other_sprites = self.game.all_sprites.sprites()
-        if self.sprite in all_other_sprites:
+        nearby_sprites = self.game.all_sprites.nearby(self.sprite.rect)
+        if self.sprite in nearby_sprites:
             # It might not be, if we're just testing a potential position
-            all_other_sprites.remove(self.sprite)
+            nearby_sprites.remove(self.sprite)
+        hitbox = self.sprite.hitbox()
         collision_test = pygame.sprite.collide_mask
-        collided_sprites = [s for s in all_other_sprites if collision_test(self.sprite, s)]
+        collided_sprites = [s for s in nearby_sprites if hitbox.colliderect(s.hitbox()) and collision_test(self.sprite, s)]
         # This is what pygame.sprite.spritecollide is for, but it wasn't working for some reason.
         return collided_sprites
 
@@ -149,6 +154,8 @@ class Agent(object):
         if self.colliding():
             self.sprite.rect = oldpos
             return False
+        self.sprite.dirty = 1
+        self.game.all_sprites.reindex(self.sprite)
         return True
 
     def stand(self, direction = None):
@@ -165,7 +172,9 @@ class Agent(object):
             font = self.game.font
         offset = -1 * (self.sprite.rect.height/2 + font.get_height()/2 + 2)
         location = self.sprite.rect.move(0, offset)
-        self.game.all_particles.add(particles.TextParticle(font, message, location))
+        particle = particles.TextParticle(font, message, location)
+        self.game.all_particles.add(particle)
+        self.game.all_visible.add(particle)
 
     def interject(self, message, font = None):
         "Low-priority say(); discard if too frequent."
@@ -0,0 +1,70 @@
+from wanderer import world
+
+class Camera(object):
+    """
+    Shows the part of the map around an agent, with the sprites over it. Arguments:
+        game_map    (world.Map whose view the camera moves)
+        target      (optional: agents.Agent to keep in the middle of the view)
+
+    Sprites' rects are in map pixel coordinates, like the agents using them; the camera only draws the sprites which overlap the view, moved into screen coordinates.
+    """
+
+    BACKGROUND = (0, 0, 0)  # shown beyond the edges of the map
+
+    def __init__(self, game_map, target = None):
+        super(Camera, self).__init__()
+        self.map = game_map
+        self.target = target
+        self.drawn = {}
+        # sprite to the screen rect it was last drawn at
+
+    def to_screen(self, rect):
+        "Return a copy of a map pixel rect moved into screen coordinates."
+        return rect.move(-self.map.view.x, -self.map.view.y)
+
+    def to_map(self, rect):
+        "Return a copy of a screen rect moved into map pixel coordinates."
+        return rect.move(self.map.view.topleft)
+
+    def update(self):
+        "Move the view to keep the target in the middle, as far as the edges of the map allow."
+        if self.target is None:
+            return
+        view = self.map.view.copy()
+        view.center = self.target.sprite.rect.center
+        view.clamp_ip(self.map.px_rect)
+        self.map.move_view(view.x, view.y)
+
+    def draw(self, screen, sprites):
+        "Draw whatever changed in the view onto screen: the map's dirty_rects, and any of the sprites given (in drawing order) which changed or moved. Returns a list of the screen rects drawn on."
+        view = self.map.view
+        areas = self.map.dirty_rects
+        self.map.dirty_rects = []
+        shown = []
+        for sprite in sprites:
+            if sprite.rect.colliderect(view):
+                shown.append((sprite, sprite.rect.move(-view.x, -view.y)))
+        drawn = dict(shown)
+        for sprite, rect in self.drawn.items():
+            if drawn.get(sprite) != rect:
+                # it moved or went away; clean up where it was
+                areas.append(rect)
+        for sprite, rect in shown:
+            if self.drawn.get(sprite) != rect or sprite.dirty:
+                areas.append(rect)
+            if sprite.dirty == 1:
+                sprite.dirty = 0
+        self.drawn = drawn
+
+        screen_rect = screen.get_rect()
+        areas = [area.clip(screen_rect) for area in areas if area.colliderect(screen_rect)]
+        if len(areas) > world.DIRTY_RECT_LIMIT:
+            areas = [areas[0].unionall(areas)]
+        for area in areas:
+            screen.fill(self.BACKGROUND, area)
+            screen.blit(self.map.surface, area, area)
+            for sprite, rect in shown:
+                if rect.colliderect(area):
+                    clipped = rect.clip(area)
+                    screen.blit(sprite.image, clipped, clipped.move(-rect.x, -rect.y))
+        return areas
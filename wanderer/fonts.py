@@ -0,0 +1,35 @@
+"""
+Shared font objects, and a cache of text rendered with them.
+"""
+
+import os, collections, pygame
+from wanderer.constants import *
+
+RENDER_CACHE_SIZE = 256     # rendered surfaces to keep around
+
+
+def get_font(filename, size):
+    "Return a shared pygame.font.Font for a file in the fonts directory at the given point size, loading it only the first time."
+    key = (filename, size)
+    if not all_fonts.has_key(key):
+        all_fonts[key] = pygame.font.Font(os.path.join(DATA_DIR, "fonts", filename), size)
+    return all_fonts[key]
+
+def render(font, message, color, antialias = False):
+    """
+    Return a pygame.Surface of the message rendered in the given font and color, reusing it if it was rendered recently.
+
+    The surface may be handed out again later, so copy it before changing it (e.g. its alpha).
+    """
+    key = (font, message, tuple(color), antialias)
+    surface = rendered.pop(key, None)
+    if surface is None:
+        surface = font.render(message, antialias, color)
+        if len(rendered) >= RENDER_CACHE_SIZE:
+            rendered.popitem(last = False)
+            # least recently used
+    rendered[key] = surface
+    return surface
+
+all_fonts = {}
+rendered = collections.OrderedDict()
@@ -1,6 +1,6 @@
-import pygame, sys, random, jsonpickle, json
+import pygame, sys, random, json
 from wanderer.constants import *
-from wanderer import agents, sprites, particles, timers, world
+from wanderer import agents, sprites, particles, timers, world, fonts, profiler, camera, savefile, journal
 
 FONT_SIZE = 8       # point
 BIG_FONT_SIZE = 16  # point
@@ -12,6 +12,10 @@ SPLASH_TEXT_COLOR = (235, 180, 215)
 WINDOW_HEIGHT = 640 # pixels (starting)
 WINDOW_WIDTH = 640  # pixels (starting)
 WINDOW_TITLE = "Wanderer"
+MAP_SIZE = 20       # tiles along each side of a new map
+FRAME_RATE = 40     # frames per second (at most)
+TICK_LENGTH = 25    # milliseconds of game time per simulation tick
+MAX_TICKS = 5       # ticks per frame before the game slows down instead
 
 KEY_DELAY = 200     # ms before keys start repeating
 KEY_INTERVAL = 10   # ms between key repeats
@@ -21,51 +25,83 @@ UP_KEYS = (K_k, K_UP)
 DOWN_KEYS = (K_j, K_DOWN)
 
 SAVEFILE = "wanderer.sav" 
+JOURNAL_FILE = SAVEFILE + ".journal"
+AUTOSAVE_INTERVAL = 5000    # ms of game time between journal writes
+COMPACT_EDITS = 20000       # journal lines before they're folded into the savefile
 
 
 class Game(object):
     """
-    Game manager for display, timers, controls, etc.
-
-    No arguments.
+    Game manager for display, timers, controls, etc. Arguments:
+        headless    (optional: if True, skip the splash screens and rendering,
+                     and run one tick per loop as fast as possible; for use
+                     with SDL's dummy driver)
+        frame_rate  (optional: most frames to draw per second, or 0 for no limit)
+        profile_csv (optional: file to write per-frame phase timings to)
+        startup     (optional: profiler.StartupTimer to mark the steps of
+                     starting up on)
+
+    The simulation always advances in ticks of TICK_LENGTH game time, however often frames are drawn. Unless headless, tile edits are appended to a journal every AUTOSAVE_INTERVAL, and folded into a full save once there are COMPACT_EDITS of them.
     """
 
-    def __init__(self):
+    def __init__(self, headless = False, frame_rate = FRAME_RATE, profile_csv = None, startup = None):
         super(Game, self).__init__()
         self.finished = False
+        self.headless = headless
+        self.frame_rate = frame_rate
+        self.lag = 0
+        # milliseconds of real time not yet simulated
+        self.ticks = 0
+        self.startup = startup or profiler.StartupTimer()
 
         # Interface
-        self.window = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
+        if self.headless:
+            # the dummy driver defaults to 8-bit color, which mangles images
+            self.window = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT), 0, 32)
+        else:
+            self.window = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
         pygame.display.set_caption(WINDOW_TITLE)
         self.screen = pygame.display.get_surface()
         pygame.key.set_repeat(KEY_DELAY, KEY_INTERVAL)
+        self.startup.mark("display")
 
         # Font. Freeware font from http://www.04.jp.org/
-        font_file = os.path.join(DATA_DIR, "fonts", "04B_11__.TTF")
-        self.font = pygame.font.Font(font_file, FONT_SIZE)
-        self.big_font = pygame.font.Font(font_file, BIG_FONT_SIZE)
-        title_file = os.path.join(DATA_DIR, "fonts", "04B_20__.TTF")
-        self.title_font = pygame.font.Font(title_file, TITLE_SIZE)
-        self.subtitle_font = pygame.font.Font(title_file, BIG_FONT_SIZE)
+        self.font = fonts.get_font("04B_11__.TTF", FONT_SIZE)
+        self.big_font = fonts.get_font("04B_11__.TTF", BIG_FONT_SIZE)
+        self.title_font = fonts.get_font("04B_20__.TTF", TITLE_SIZE)
+        self.subtitle_font = fonts.get_font("04B_20__.TTF", BIG_FONT_SIZE)
+        self.startup.mark("fonts")
 
         # (this is the earliest we can display the splash screen)
         self.display_splash("Loading ...")
+        self.startup.mark("splash")
 
         # Files
         self.texts = {}
         self.sprites = {}
         self.init_files()
+        self.startup.mark("text and images")
 
         # Sprites and agents
-        self.all_particles = pygame.sprite.RenderUpdates()
-        self.all_sprites = pygame.sprite.RenderUpdates()
+        self.all_particles = pygame.sprite.Group()
+        self.all_sprites = sprites.SpatialGroup()
+        self.all_visible = pygame.sprite.LayeredUpdates()
+        # ^ everything drawn over the map, particles and sprites alike
         self.all_agents = []
         self.all_npcs = []
 
         # Miscellany
         self.clock = pygame.time.Clock()
+        self.journal = journal.Journal(JOURNAL_FILE)
+        self.save_thread = None
+        # the worker thread writing the latest save, if there is one
+        self.profiler = profiler.FrameProfiler(csv_path = profile_csv)
+        self.overlay_rect = None
+        # where the profiler overlay was drawn, to be cleaned up
 
     def confirm_start(self):
+        if self.headless:
+            return
         self.display_splash("Ready!", "(hit enter)")
         while True:
             event = pygame.event.wait()
@@ -75,12 +111,26 @@ class Game(object):
                 if event.key is K_q:
                     self.quit()
                     break
-
-    def new(self):
-        self.map = world.Map(pygame.Rect(0, 0, 20, 20))
+        self.startup.mark("waiting for enter", counted = False)
+
+    def new(self, size = MAP_SIZE, map_file = None):
+        "Start a new game, on a map loaded from a .tmx file if one is given, or else a generated map size tiles square."
+        if map_file:
+            from wanderer import tmx
+            # only needed for Tiled maps
+            self.map = tmx.load_map(map_file, view = self.screen.get_rect())
+        else:
+            self.map = world.Map(pygame.Rect(0, 0, size, size), view = self.screen.get_rect())
         self.player = agents.Player(self, "Player")
+        self.camera = camera.Camera(self.map, self.player)
+        if not self.headless:
+            # a full save for the journal to start from
+            self.save()
+            timers.Timer(AUTOSAVE_INTERVAL, self.autosave)
 
     def display_splash(self, message = None, small_message = None):
+        if self.headless:
+            return
         def centered(surface):
             return self.screen.get_rect().width/2 - surface.get_rect().width/2
         title_color = SPLASH_TEXT_COLOR
@@ -101,10 +151,32 @@ class Game(object):
         pygame.display.flip()
 
     def loop(self):
-        "Handle events, check timers, update sprites and particles, and re-render the screen."
-        self.clock.tick(40)
-        loop_time = self.clock.get_time()
-
+        "Handle events, run any simulation ticks which have come due, and re-render the screen."
+        if self.headless:
+            self.profiler.start_frame()
+            self.handle_events()
+            self.profiler.lap("events")
+            self.tick()
+            self.map.dirty_rects = []
+            self.profiler.end_frame()
+            return
+
+        self.lag += self.clock.tick(self.frame_rate)
+        if self.lag > MAX_TICKS * TICK_LENGTH:
+            # too far behind to catch up, so let the game slow down
+            self.lag = MAX_TICKS * TICK_LENGTH
+        self.profiler.start_frame()
+        self.handle_events()
+        self.profiler.lap("events")
+        while self.lag >= TICK_LENGTH:
+            self.tick()
+            self.lag -= TICK_LENGTH
+        self.render()
+        self.profiler.lap("draw")
+        self.profiler.end_frame()
+
+    def handle_events(self):
+        "Internal. Pass new events to their controls."
         new_events = pygame.event.get()
         for event in new_events:
             """
@@ -118,23 +190,31 @@ class Game(object):
                 for handler in self.handlers[event.type]:
                     handler.respond(event)
 
+    def tick(self):
+        "Advance the simulation by TICK_LENGTH: check timers, and update agents, sprites, particles and the map."
         for agent in self.all_agents:
             agent.update()
+        self.profiler.lap("agents")
         self.all_sprites.update()
         self.all_particles.update()
-        for timer in timers.all_timers:
-            timer.update(loop_time)
-
-        self.map.update()
-        if self.map.dirty:
-            self.screen.blit(self.map.surface, (0, 0))
-            self.map.dirty = False
-        else:
-            self.all_sprites.clear(self.screen, self.map.surface)
-            self.all_particles.clear(self.screen, self.map.surface)
-        self.all_sprites.draw(self.screen)
-        self.all_particles.draw(self.screen)
-        pygame.display.flip()
+        self.profiler.lap("sprites")
+        timers.scheduler.update(TICK_LENGTH)
+        self.profiler.lap("timers")
+        self.map.update([agent.sprite.rect for agent in self.all_agents])
+        self.profiler.lap("map")
+        self.ticks += 1
+
+    def render(self):
+        "Internal. Move the camera, and draw whatever changed since the last frame to the screen."
+        self.camera.update()
+        if self.overlay_rect:
+            self.map.dirty_rects.append(self.overlay_rect)
+            self.overlay_rect = None
+        changed = self.camera.draw(self.screen, self.all_visible.sprites())
+        self.overlay_rect = self.profiler.draw(self.screen, self.font)
+        if self.overlay_rect:
+            changed.append(self.overlay_rect)
+        pygame.display.update(changed)
 
     def init_files(self):
         "Internal. Initialize data files."
@@ -184,6 +264,8 @@ class Game(object):
         # Miscellaneous
         controls.append(Control([QUIT, KEYDOWN], [K_q], self.quit))
         controls.append(Control([KEYDOWN], [K_n], agents.Npc, self))
+        controls.append(Control([KEYDOWN], [K_F3], self.profiler.toggle))
+        controls.append(Control([KEYDOWN], [K_s], self.save))
 
         # Debug
         def p(*args):
@@ -206,25 +288,63 @@ class Game(object):
         self.handlers = handlers
 
     def save(self):
+        "Take a snapshot of the game, and start writing it to the savefile in the background."
         savegame = {}
         savegame["map"] = self.map
         savegame["player"] = self.player
         savegame["npcs"] = self.all_npcs
-        with open(SAVEFILE, 'w') as savefile:
-            json.dump(self.map.to_json(), savefile, sort_keys=True, indent=4)
+        self.finish_saving()
+        # the journal covers everything up to the snapshot, in case the
+        # game stops before it's written
+        self.journal.write(self.map)
+        snapshot = savefile.snapshot(self.map)
+        self.journal.rotate()
+        self.save_thread = savefile.write_in_background(snapshot, SAVEFILE, finished = self.saved)
+
+    def saved(self):
+        "Internal. Called on the worker thread once the savefile is written."
+        self.journal.discard_previous()
         print "Game saved."
 
+    def finish_saving(self):
+        "Wait for the save being written in the background, if there is one."
+        if self.save_thread:
+            self.save_thread.join()
+            self.save_thread = None
+
+    def autosave(self):
+        "Internal. Append the tile edits since the last autosave to the journal, or fold them all into a full save once the journal is long, then wait to do it again."
+        if self.journal.entries + len(self.map.edits) >= COMPACT_EDITS:
+            self.save()
+        else:
+            self.journal.write(self.map)
+        timers.Timer(AUTOSAVE_INTERVAL, self.autosave)
+
     def load(self):
-        with open(SAVEFILE) as savefile:
-            savegame = json.load(savefile)
+        self.finish_saving()
+        if savefile.is_savefile(SAVEFILE):
             print "Loading saved game."
-        self.map = world.Map.from_json(savegame)
+            self.map = savefile.load(SAVEFILE, view = self.screen.get_rect())
+        else:
+            # from before the binary format
+            with open(SAVEFILE) as json_file:
+                savegame = json.load(json_file)
+                print "Loading saved game."
+            self.map = world.Map.from_json(savegame, view = self.screen.get_rect())
+        replayed = self.journal.replay(self.map)
+        if replayed:
+            print "Recovered {} tile edits made after the last save.".format(replayed)
         self.player = agents.Player(self, "Player")
+        self.camera = camera.Camera(self.map, self.player)
         self.all_npcs = []
+        if not self.headless:
+            timers.Timer(AUTOSAVE_INTERVAL, self.autosave)
 
     def quit(self):
         "Exit the game politely."
         self.save()
+        self.finish_saving()
+        self.profiler.close()
         self.finished = True
 
 
@@ -0,0 +1,95 @@
+import json, os, shutil
+from wanderer import world
+
+
+class Journal(object):
+    """
+    An append-only file of the tile edits made to a map since it was last saved in full. Arguments:
+        path    (filename of the journal; it's only created once there's something in it)
+
+    Each line holds one location's latest contents, so replaying the lines in order over the last full save brings the map up to date. A line cut short by a crash is dropped, along with anything after it. While a full save is being written, the lines it covers are set aside in a previous journal, which is replayed first.
+    """
+
+    def __init__(self, path):
+        super(Journal, self).__init__()
+        self.path = path
+        self.previous_path = path + ".prev"
+        self.entries = 0
+        # lines in the journal since it was last set aside
+
+    def write(self, game_map):
+        "Append the map's edits since the last write, and forget them. Returns how many were written."
+        if not game_map.edits:
+            return 0
+        lines = []
+        for (tier_index, name, x, y), layer in game_map.edits.items():
+            tile = layer.stored_tile(x, y)
+            tile_json = None
+            if tile and not tile.kill:
+                tile_json = tile.to_json()
+            lines.append(json.dumps([tier_index, name, x, y, tile_json]) + "\n")
+        game_map.edits.clear()
+        with open(self.path, "ab") as journal_file:
+            journal_file.write("".join(lines))
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        self.entries += len(lines)
+        return len(lines)
+
+    def replay(self, game_map):
+        "Apply the previous journal's edits and then the journal's to a map just loaded from the last full save. Returns how many were applied."
+        replayed = self.replay_file(self.previous_path, game_map)
+        self.entries = self.replay_file(self.path, game_map)
+        game_map.edits.clear()
+        return replayed + self.entries
+
+    def replay_file(self, path, game_map):
+        "Internal. Apply the edits in one journal file to a map; returns how many were applied."
+        try:
+            with open(path, "rb") as journal_file:
+                data = journal_file.read()
+        except IOError:
+            return 0
+        replayed = 0
+        good_length = 0
+        for line in data.splitlines(True):
+            try:
+                if not line.endswith("\n"):
+                    raise ValueError("unfinished line")
+                tier_index, name, x, y, tile_json = json.loads(line)
+            except ValueError:
+                break
+            good_length += len(line)
+            layer = game_map.find_layer(tier_index, name, x, y)
+            if layer is None:
+                continue
+            tile = None
+            if tile_json:
+                tile = world.Tile.from_json(tile_json)
+            layer.restore_tile(x, y, tile)
+            replayed += 1
+        if good_length < len(data):
+            # the game crashed partway through a write; cut it off so new
+            # lines don't follow on from it
+            with open(path, "r+b") as journal_file:
+                journal_file.truncate(good_length)
+        return replayed
+
+    def rotate(self):
+        "Set the journal's lines aside as the previous journal, when a full save covering them is started. They're kept until discard_previous() is called, once that save is written."
+        if os.path.exists(self.path):
+            if os.path.exists(self.previous_path):
+                # the last full save never got written, so its lines are
+                # still needed too
+                with open(self.previous_path, "ab") as previous_file:
+                    with open(self.path, "rb") as journal_file:
+                        shutil.copyfileobj(journal_file, previous_file)
+                os.remove(self.path)
+            else:
+                os.rename(self.path, self.previous_path)
+        self.entries = 0
+
+    def discard_previous(self):
+        "Delete the previous journal, once the full save started by rotate() is written."
+        if os.path.exists(self.previous_path):
+            os.remove(self.previous_path)
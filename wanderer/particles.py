@@ -1,17 +1,18 @@
 import pygame
-from wanderer import timers
+from wanderer import timers, fonts
 
 class Particle(pygame.sprite.DirtySprite):
     """
     A temporary sprite which will disappear after a short time. Arguments:
         surface     (pygames.Surface, particle contents)
-        location    (pygames.Rect, particle will be centered on it)
+        location    (pygames.Rect in map pixel coordinates, particle will be centered on it)
         timeout     (milliseconds)
         vector      ((x, y) integer tuple, defaults to (0,0) for no movement)
         fade        (boolean, defaults to False)
     """
 
     PARTICLE_DEFAULT_TIMEOUT = 500  # milliseconds
+    _layer = 1      # drawn above characters, see game.Game.all_visible
     FADE_STEPS = 5
     FADE_AMOUNT = 255/FADE_STEPS
 
@@ -34,10 +35,13 @@ class Particle(pygame.sprite.DirtySprite):
     def fade(self):
         "Internal. Change the particle transparency."
         self.image.set_alpha(self.image.get_alpha() - self.FADE_AMOUNT)
+        self.dirty = 1
 
     def update(self):
         "Update the particle position."
-        self.rect.move_ip(self.vector)
+        if self.vector != (0, 0):
+            self.rect.move_ip(self.vector)
+            self.dirty = 1
 
 
 class TextParticle(Particle):
@@ -50,7 +54,8 @@ class TextParticle(Particle):
     # size settings are in game.Game
 
     def __init__(self, font, message, location, timeout = None, vector = (0, -1), fade = True):
-        text = font.render(message, False, self.FONT_COLOR)
+        text = fonts.render(font, message, self.FONT_COLOR).copy()
+        # a copy, because fading changes its alpha
         if timeout is None:
             timeout = len(message) * self.TEXT_TIMEOUT_PER_CHAR
         super(TextParticle, self).__init__(text, location, timeout, vector, fade)
@@ -0,0 +1,158 @@
+import collections, csv, os, timeit, pygame
+
+class FrameProfiler(object):
+    """
+    Times the phases of each frame and keeps rolling percentiles of them. Arguments:
+        phases      (optional: names of the phases, in the order they happen)
+        window      (optional: how many recent frames the percentiles cover)
+        csv_path    (optional: file to write each frame's timings to)
+
+    Call start_frame(), then lap(phase) as each phase finishes (a phase may finish more than once per frame; the times add up), then end_frame().
+    """
+
+    PHASES = ("events", "agents", "sprites", "timers", "map", "draw")
+    WINDOW = 200            # frames
+    PERCENTILES = (50, 95, 99)
+    REFRESH = 10            # frames between redrawing the overlay
+    TEXT_COLOR = (255, 255, 255)
+    BACKGROUND = (0, 0, 0, 180)
+    MARGIN = 4              # pixels
+
+    def __init__(self, phases = PHASES, window = WINDOW, csv_path = None):
+        super(FrameProfiler, self).__init__()
+        self.phases = list(phases)
+        self.columns = self.phases + ["total"]
+        self.history = dict((name, collections.deque(maxlen = window)) for name in self.columns)
+        self.times = dict.fromkeys(self.columns, 0.0)
+        self.frames = 0
+        self.frame_start = self.mark = timeit.default_timer()
+        self.visible = False
+        self.overlay = None
+        self.csv_file = None
+        if csv_path:
+            self.csv_file = open(csv_path, "wb")
+            self.csv_writer = csv.writer(self.csv_file)
+            self.csv_writer.writerow(["frame"] + ["{}_ms".format(name) for name in self.columns])
+
+    def start_frame(self):
+        "Start timing a new frame."
+        for name in self.columns:
+            self.times[name] = 0.0
+        self.frame_start = self.mark = timeit.default_timer()
+
+    def lap(self, phase):
+        "Charge the time since the last lap (or the start of the frame) to the given phase."
+        now = timeit.default_timer()
+        self.times[phase] += now - self.mark
+        self.mark = now
+
+    def end_frame(self):
+        "Finish timing the frame, and record it."
+        self.times["total"] = timeit.default_timer() - self.frame_start
+        for name in self.columns:
+            self.history[name].append(self.times[name])
+        self.frames += 1
+        if self.csv_file:
+            self.csv_writer.writerow([self.frames] + ["{:.3f}".format(self.times[name] * 1000) for name in self.columns])
+
+    def percentiles(self, phase):
+        "Returns a list of the PERCENTILES of recent times for a phase, in milliseconds."
+        history = sorted(self.history[phase])
+        if not history:
+            return [0.0 for p in self.PERCENTILES]
+        last = len(history) - 1
+        return [history[min(last, len(history) * p / 100)] * 1000 for p in self.PERCENTILES]
+
+    def toggle(self):
+        "Show or hide the overlay."
+        self.visible = not self.visible
+        self.overlay = None
+
+    def draw(self, surface, font):
+        "Draw the overlay in the top left of a surface, if it's visible. Returns the pygame.Rect drawn on, or None."
+        if not self.visible:
+            return None
+        if self.overlay is None or not self.frames % self.REFRESH:
+            self.overlay = self.render(font)
+        return surface.blit(self.overlay, (0, 0))
+
+    def render(self, font):
+        "Internal. Returns a pygame.Surface with a table of the current percentiles."
+        header = "{:<8}".format("ms") + "".join("{:>7}".format("p{}".format(p)) for p in self.PERCENTILES)
+        lines = [header]
+        for name in self.columns:
+            lines.append("{:<8}".format(name) + "".join("{:>7.2f}".format(t) for t in self.percentiles(name)))
+        rendered = [font.render(line, False, self.TEXT_COLOR) for line in lines]
+        line_height = font.get_linesize()
+        width = max(text.get_width() for text in rendered) + 2 * self.MARGIN
+        height = line_height * len(rendered) + 2 * self.MARGIN
+        overlay = pygame.Surface((width, height), pygame.SRCALPHA)
+        overlay.fill(self.BACKGROUND)
+        for i, text in enumerate(rendered):
+            overlay.blit(text, (self.MARGIN, self.MARGIN + i * line_height))
+        return overlay
+
+    def close(self):
+        "Finish writing the CSV file, if there is one."
+        if self.csv_file:
+            self.csv_file.close()
+            self.csv_file = None
+
+
+class StartupTimer(object):
+    """
+    Times the steps of starting the game, up to its first frame. Arguments:
+        start   (optional: timeit.default_timer() when the program started;
+                 defaults to now)
+
+    Call mark(step) as each step finishes, then report(). Where the system says how old the process is, the time spent starting the interpreter before start is counted as a step too.
+    """
+
+    def __init__(self, start = None):
+        super(StartupTimer, self).__init__()
+        now = timeit.default_timer()
+        if start is None:
+            start = now
+        self.start = self.last = start
+        self.steps = []
+        # (step, seconds, counted)
+        age = process_age()
+        if age is not None and age > now - start:
+            self.steps.append(("interpreter", age - (now - start), True))
+
+    def mark(self, step, at = None, counted = True):
+        "Charge the time since the last mark (or the start) to the given step, up to now or the timeit.default_timer() time at. Steps which aren't counted, like waiting for the player, are listed but left out of the total."
+        if at is None:
+            at = timeit.default_timer()
+        self.steps.append((step, at - self.last, counted))
+        self.last = at
+
+    def total(self):
+        "Returns the seconds taken by all the counted steps so far."
+        return sum(seconds for step, seconds, counted in self.steps if counted)
+
+    def report(self):
+        "Returns a table of each step's time in milliseconds, and the total, as a string."
+        lines = []
+        for step, seconds, counted in self.steps:
+            note = ""
+            if not counted:
+                note = "  (not counted)"
+            lines.append("{:<20}{:>8.1f}{}".format(step, seconds * 1000, note))
+        lines.append("{:<20}{:>8.1f}".format("total", self.total() * 1000))
+        return "\n".join(lines)
+
+
+def process_age():
+    "Returns how many seconds ago this process started, or None if the system won't say (only Linux does, through /proc)."
+    try:
+        with open("/proc/self/stat") as stat_file:
+            stat = stat_file.read()
+        with open("/proc/uptime") as uptime_file:
+            uptime = float(uptime_file.read().split()[0])
+        # fields after the command name, which is in parentheses and may
+        # contain spaces; the process's start time is the 22nd field
+        started = float(stat.rsplit(")", 1)[1].split()[19]) / os.sysconf("SC_CLK_TCK")
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+    return uptime - started
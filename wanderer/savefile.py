@@ -0,0 +1,206 @@
+import json, operator, os, struct, threading, zlib, numpy, pygame
+from wanderer import world
+
+MAGIC = "WANDERER"
+VERSION = 2
+HEADER = struct.Struct("<8sHBI")
+# magic, version, compression, then the length of the metadata after it;
+# the rest of the file is a record for each chunk, compressed separately so
+# they can be read one at a time
+RECORD_HEADER = struct.Struct("<I")
+# length of a record's metadata; the arrays it points into follow it
+NO_COMPRESSION = 0
+ZLIB = 1
+COMPRESS_LEVEL = 6
+
+
+def is_savefile(filename):
+    "Return True if the file is a binary savefile (rather than an old JSON one)."
+    with open(filename, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def snapshot(game_map):
+    """
+    Return a copy of what save() needs from a world.Map, to write() later, perhaps on another thread.
+
+    Loaded chunks are copied as arrays, while packed stored chunks are shared, since nothing changes them. Any chunks still stored as JSON are packed first, and stay that way.
+    """
+    chunks = [chunk.pack() for chunk in game_map.chunks.values()]
+    for key, json_chunk in game_map.stored.items():
+        if not json_chunk.get("packed"):
+            # stored from an old JSON savefile
+            json_chunk = world.Chunk.from_json(json_chunk).pack()
+            game_map.stored[key] = json_chunk
+        chunks.append(json_chunk)
+    layer_class = game_map.layer_class or world.Layer
+    return {"rect": tuple(game_map.rect), "chunk_size": game_map.chunk_size,
+            "layer_type": layer_class.__name__, "source": game_map.source,
+            "tile_types": [(tile_class.__name__, name) for tile_class, name in world.tile_types[1:]],
+            "chunks": chunks}
+
+def write(snapshot, filename, compress = True):
+    """
+    Write a snapshot() to a binary savefile, compressing each chunk's record with zlib if compress is true.
+
+    Each layer is saved as the arrays ArrayLayer keeps, with tiles as small ids from world.tile_type_id. The class and name each id stands for is saved once, so loading can map them back however the ids turn out that time. The file is written beside the old one and then renamed over it, so an interrupted save leaves the old one alone.
+    """
+    compression = NO_COMPRESSION
+    if compress:
+        compression = ZLIB
+    records = []
+    chunks = []
+    # (rect, offset, length) of each chunk's record, after the metadata
+    offset = 0
+    for json_chunk in snapshot["chunks"]:
+        record = None
+        if isinstance(json_chunk, StoredChunk):
+            record = json_chunk.reusable_record(compression)
+        if record is None:
+            record = pack_record(json_chunk["tiers"], compression)
+        chunks.append((json_chunk["rect"], offset, len(record)))
+        records.append(record)
+        offset += len(record)
+    meta = json.dumps(dict(snapshot, chunks = chunks))
+    temp_filename = filename + ".tmp"
+    with open(temp_filename, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, compression, len(meta)))
+        f.write(meta)
+        for record in records:
+            f.write(record)
+        f.flush()
+        os.fsync(f.fileno())
+    replace_file(temp_filename, filename)
+
+def pack_record(json_tiers, compression):
+    "Internal. Return a chunk's packed tiers (see Chunk.pack) as a savefile record."
+    arrays = []
+    # (offset, dtype, shape) after the record's metadata
+    blobs = []
+    offset = 0
+    tiers = []
+    for json_tier in json_tiers:
+        layers = {}
+        for name, json_layer in json_tier["layers"].items():
+            fields = {}
+            for field, array in json_layer["arrays"].items():
+                blob = numpy.ascontiguousarray(array).tostring()
+                fields[field] = len(arrays)
+                arrays.append((offset, array.dtype.str, array.shape))
+                blobs.append(blob)
+                offset += len(blob)
+            layers[name] = {"type": json_layer["type"], "rect": json_layer["rect"], "arrays": fields}
+        tiers.append({"rect": json_tier["rect"], "layer_names": json_tier["layer_names"], "layers": layers})
+    meta = json.dumps({"tiers": tiers, "arrays": arrays})
+    record = RECORD_HEADER.pack(len(meta)) + meta + "".join(blobs)
+    if compression == ZLIB:
+        record = zlib.compress(record, COMPRESS_LEVEL)
+    return record
+
+def unpack_record(record, compression, type_ids):
+    "Internal. Return the packed tiers in a savefile record, with their tile type ids mapped through the array type_ids."
+    if compression == ZLIB:
+        record = zlib.decompress(record)
+    meta_length, = RECORD_HEADER.unpack_from(record)
+    meta = json.loads(str(buffer(record, RECORD_HEADER.size, meta_length)))
+    return unpack_tiers(meta["tiers"], meta["arrays"], record, RECORD_HEADER.size + meta_length, type_ids)
+
+def unpack_tiers(json_tiers, arrays, data, start, type_ids):
+    "Internal. Fill in the arrays of a chunk's tiers from the (offset, dtype, shape) list they point into, whose offsets count from start in data."
+    for json_tier in json_tiers:
+        for json_layer in json_tier["layers"].values():
+            fields = {}
+            for field, index in json_layer["arrays"].items():
+                offset, dtype, shape = arrays[index]
+                count = reduce(operator.mul, shape, 1)
+                fields[field] = numpy.frombuffer(data, dtype, count, start + offset).reshape(shape)
+            fields["types"] = type_ids[fields["types"]]
+            json_layer["arrays"] = fields
+    return json_tiers
+
+
+class StoredChunk(dict):
+    """
+    A packed chunk (see Chunk.pack) in a savefile, which is only unpacked once something looks at its tiers. Arguments:
+        rect        (the chunk's rect, as a tuple)
+        record      (the chunk's record from the savefile)
+        compression (how the record is compressed)
+        type_ids    (NumPy array of the saved tile type ids to this run's)
+    """
+
+    def __init__(self, rect, record, compression, type_ids):
+        super(StoredChunk, self).__init__(rect = rect, packed = True)
+        self.record = record
+        self.compression = compression
+        self.type_ids = type_ids
+
+    def __missing__(self, key):
+        if key != "tiers":
+            raise KeyError(key)
+        tiers = unpack_record(self.record, self.compression, self.type_ids)
+        self["tiers"] = tiers
+        return tiers
+
+    def reusable_record(self, compression):
+        "Return the record as it can be written to a new savefile with the given compression, or None if it needs packing again."
+        if self.compression != compression or self.has_key("tiers"):
+            return None
+        if (self.type_ids[1:] != numpy.arange(1, len(self.type_ids))).any():
+            # the tile type ids mean something else this time
+            return None
+        return self.record
+
+
+def save(game_map, filename, compress = True):
+    "Write a world.Map to a binary savefile (see write)."
+    write(snapshot(game_map), filename, compress)
+
+def write_in_background(snapshot, filename, compress = True, finished = None):
+    "Start a worker thread which writes a snapshot() to a savefile, then calls finished (if given) with no arguments; returns the thread."
+    def work():
+        try:
+            write(snapshot, filename, compress)
+        except (IOError, OSError) as error:
+            print "Couldn't save the game: {}".format(error)
+            return
+        if finished:
+            finished()
+    thread = threading.Thread(target = work, name = "save")
+    thread.start()
+    return thread
+
+def replace_file(source, destination):
+    "Rename source over destination, atomically where the system allows."
+    try:
+        os.rename(source, destination)
+    except OSError:
+        # Windows won't rename over an existing file
+        if not os.path.exists(destination):
+            raise
+        os.remove(destination)
+        os.rename(source, destination)
+
+def load(filename, view = None):
+    "Return the world.Map in a binary savefile. Only the outline of the map is read up front; each chunk is unpacked when it's first needed, and its arrays are copied into the chunk's layers when it's loaded."
+    with open(filename, "rb") as f:
+        data = f.read()
+    magic, version, compression, meta_length = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("{} is not a savefile".format(filename))
+    if version != VERSION:
+        raise ValueError("{} uses savefile format {}, which can't be read".format(filename, version))
+    if compression not in (NO_COMPRESSION, ZLIB):
+        raise ValueError("{} uses unknown compression {}".format(filename, compression))
+    meta = json.loads(str(buffer(data, HEADER.size, meta_length)))
+    type_ids = map_type_ids(meta["tile_types"])
+    start = HEADER.size + meta_length
+    chunks = [StoredChunk(rect, buffer(data, start + offset, length), compression, type_ids)
+              for rect, offset, length in meta["chunks"]]
+    layer_class = getattr(world, meta["layer_type"])
+    return world.Map.from_chunks(pygame.Rect(*meta["rect"]), chunks, layer_class, meta["chunk_size"], view, meta["source"])
+
+def map_type_ids(tile_types):
+    "Internal. Return a NumPy array of the tile type ids in a savefile, given its list of their (class name, name), to this run's ids."
+    type_ids = numpy.zeros(len(tile_types) + 1, numpy.uint16)
+    for saved_id, (class_name, name) in enumerate(tile_types, 1):
+        type_ids[saved_id] = world.tile_type_id(getattr(world, class_name), name)
+    return type_ids
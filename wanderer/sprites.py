@@ -1,4 +1,4 @@
-import pygame, os, random
+import pygame, os, random, copy
 from wanderer import timers
 from wanderer.constants import *
 
@@ -7,25 +7,25 @@ class Character(pygame.sprite.DirtySprite):
     """
     Animated character sprite. Arguments:
         agent           (agents.Agent this sprite belongs to)
-        sheet           (pygame.Surface containing a sprite sheet)
+        animations      (list of Animations by direction, from get_animations())
         location        (pygame.Rect where the sprite should be)
         direction       (optional: which way the sprite should start facing)
 
-    The sprite sheet will be chopped up and animated according to various layouts specs in the constants module.
+    The character plays copies of the animations given, so the frames are shared but each character keeps its own place in them.
     """
 
     WALK_RATE = 250     # milliseconds between animation frames
+    _layer = 0          # drawing order, see game.Game.all_visible
 
-    def __init__(self, agent, sheet, location, direction = DOWN):
+    def __init__(self, agent, animations, location, direction = DOWN):
         super(Character, self).__init__()
         self.agent = agent
-        self.sheet = sheet
-        self.animations = []
-        self.init_images()
+        self.animations = [animation.copy() for animation in animations]
         self.rect = location
         self.direction = direction
         self.animation = self.animations[self.direction]
-        self.agent.game.all_sprites.add(self)
+        self.image = None
+        self.add(self.agent.game.all_sprites, self.agent.game.all_visible)
         self.update()
         self.dirty = 1
 
@@ -33,19 +33,18 @@ class Character(pygame.sprite.DirtySprite):
         "Developer-facing string representation."
         return "{}'s sprite".format(self.agent)
 
-    def init_images(self):
-        "Internal. Initialize animation frames from sprite sheet."
-        for direction in (DOWN, LEFT, RIGHT, UP):
-            frames = []
-            for position in xrange(3):
-                cursor = pygame.Rect(position * SPRITE_WIDTH, direction * SPRITE_HEIGHT, SPRITE_WIDTH, SPRITE_HEIGHT)
-                frames.append(self.sheet.subsurface(cursor))
-            frames.append(frames[1])
-            self.animations.append(Animation(frames, self.WALK_RATE))
-
     def update(self):
-        "Update the sprite image."
-        self.image = self.animation.image()
+        "Update the sprite image and mask, and flag it for redrawing if it changed."
+        image = self.animation.image()
+        if image is not self.image:
+            self.image = image
+            self.mask = self.animation.mask()
+            self.bounds = self.animation.bounds()
+            self.dirty = 1
+
+    def hitbox(self):
+        "Returns a pygame.Rect tightly enclosing the opaque parts of the current frame."
+        return self.bounds.move(self.rect.topleft)
 
     def kill(self):
         self.animation.stop()
@@ -74,6 +73,101 @@ class Character(pygame.sprite.DirtySprite):
         self.animation.start()
 
 
+def load_sheet(filename):
+    "Return the image file given as a converted pygame.Surface, loading it only the first time it's asked for."
+    if not all_sheets.has_key(filename):
+        all_sheets[filename] = pygame.image.load(filename).convert()
+    return all_sheets[filename]
+
+def get_animations(filename, area):
+    """
+    Return a list of Animations by direction for one character on a sprite sheet. Arguments:
+        filename    (path to the sprite sheet image)
+        area        (pygame.Rect of the character's part of the sheet)
+
+    The character's part of the sheet is chopped up and animated according to various layouts specs in the constants module. This only happens the first time; after that the same Animations are returned, so don't play them directly (Character copies them).
+    """
+    key = (filename, tuple(area))
+    if not all_animations.has_key(key):
+        sheet = load_sheet(filename).subsurface(area)
+        animations = []
+        for direction in (DOWN, LEFT, RIGHT, UP):
+            frames = []
+            for position in xrange(3):
+                cursor = pygame.Rect(position * SPRITE_WIDTH, direction * SPRITE_HEIGHT, SPRITE_WIDTH, SPRITE_HEIGHT)
+                frames.append(sheet.subsurface(cursor))
+            frames.append(frames[1])
+            animations.append(Animation(frames, Character.WALK_RATE))
+        all_animations[key] = animations
+    return all_animations[key]
+
+all_sheets = {}
+all_animations = {}
+
+
+class SpatialGroup(pygame.sprite.Group):
+    """
+    A sprite group which also files its sprites in a grid by location, to find the ones near a given area quickly. Arguments:
+        *sprites    (optional: sprites to add)
+        cell_size   (optional keyword: width and height of grid cells in pixels)
+
+    The grid isn't updated when a sprite's rect changes; call reindex() after moving one.
+    """
+
+    CELL_SIZE = 64      # pixels
+
+    def __init__(self, *sprites, **kwargs):
+        self.cell_size = kwargs.get("cell_size", self.CELL_SIZE)
+        self.cells = {}         # (column, row) to set of sprites
+        self.sprite_cells = {}  # sprite to the list of cells it's in
+        super(SpatialGroup, self).__init__(*sprites)
+
+    def add_internal(self, sprite):
+        super(SpatialGroup, self).add_internal(sprite)
+        self.index(sprite)
+
+    def remove_internal(self, sprite):
+        super(SpatialGroup, self).remove_internal(sprite)
+        self.unindex(sprite)
+
+    def cells_for(self, rect):
+        "Internal. Returns a list of the grid cells the given rect overlaps."
+        size = self.cell_size
+        columns = xrange(rect.left // size, (rect.right - 1) // size + 1)
+        rows = xrange(rect.top // size, (rect.bottom - 1) // size + 1)
+        return [(column, row) for column in columns for row in rows]
+
+    def index(self, sprite):
+        "Internal. File a sprite under the cells it currently overlaps."
+        cells = self.cells_for(sprite.rect)
+        self.sprite_cells[sprite] = cells
+        for cell in cells:
+            if self.cells.has_key(cell):
+                self.cells[cell].add(sprite)
+            else:
+                self.cells[cell] = set([sprite])
+
+    def unindex(self, sprite):
+        "Internal. Remove a sprite from the cells it was filed under."
+        for cell in self.sprite_cells.pop(sprite, ()):
+            self.cells[cell].discard(sprite)
+            if not self.cells[cell]:
+                del self.cells[cell]
+
+    def reindex(self, sprite):
+        "Update the grid after a sprite in this group has moved."
+        if self.cells_for(sprite.rect) != self.sprite_cells.get(sprite):
+            self.unindex(sprite)
+            self.index(sprite)
+
+    def nearby(self, rect):
+        "Returns a list of sprites in this group whose rects overlap the given rect."
+        candidates = set()
+        for cell in self.cells_for(rect):
+            candidates.update(self.cells.get(cell, ()))
+        return [sprite for sprite in candidates if rect.colliderect(sprite.rect)]
+
+
 class Animation(object):
     """
     Animates a sprite using a list of frame surfaces. Arguments:
@@ -81,6 +175,8 @@ class Animation(object):
         speed       (milliseconds, how frequently frames should change)
         colorkey    ((R,G,B) transparency color; detected from frames if not present)
         default     (integer, index of frame to display when not animating)
+
+    Collision masks and bounding rects for each frame are worked out once, up front.
     """
 
     def __init__(self, frames, speed, colorkey = None, default = 1):
@@ -94,6 +190,18 @@ class Animation(object):
         if not colorkey:
             colorkey = self.frames[default].get_at((0,0))
         self.colorkey = colorkey
+        self.masks = []
+        self.bounds_rects = []
+        for frame in self.frames:
+            frame.set_colorkey(self.colorkey)
+            mask = pygame.mask.from_surface(frame)
+            bounding_rects = mask.get_bounding_rects()
+            if bounding_rects:
+                bounds = bounding_rects[0].unionall(bounding_rects)
+            else:
+                bounds = pygame.Rect(0, 0, 0, 0)
+            self.masks.append(mask)
+            self.bounds_rects.append(bounds)
 
     def cycle(self):
         "Internal. Update the image, if running."
@@ -103,9 +211,23 @@ class Animation(object):
 
     def image(self):
         "Retrieve a pygame.Surface of the current animation frame."
-        image = self.frames[self.current]
-        image.set_colorkey(self.colorkey)
-        return image
+        return self.frames[self.current]
+
+    def mask(self):
+        "Retrieve a pygame.mask.Mask of the current animation frame."
+        return self.masks[self.current]
+
+    def bounds(self):
+        "Retrieve a pygame.Rect enclosing the opaque part of the current frame, relative to its top left."
+        return self.bounds_rects[self.current]
+
+    def copy(self):
+        "Return a stopped Animation which shares this one's frames and masks."
+        other = copy.copy(self)
+        other.current = other.default
+        other.running = False
+        other.timer = None
+        return other
 
     def start(self):
         "Start the animation."
@@ -1,3 +1,5 @@
+import heapq
+
 class Timer(object):
     """
     Calls a function after a specified interval. Arguments:
@@ -5,26 +7,95 @@ class Timer(object):
         action      (function)
         *arguments  (will be passed to function)
 
-    New Timers automatically add themselves to the list of timers when instantiated and remove themselves when they expire.
+    New Timers automatically schedule themselves with the scheduler when instantiated, which forgets them once they fire or are cancelled.
     """
 
     def __init__(self, timeout, action, *arguments):
         super(Timer, self).__init__()
-        self.counter = timeout
         self.action = action
         self.arguments = arguments
-        all_timers.append(self)
+        self.cancelled = False
+        self.fired = False
+        self.deadline = scheduler.schedule(self, timeout)
 
-    def update(self, loop_time):
-        "Decrement the counter; if it runs out, fire the action and self-destruct."
-        self.counter -= loop_time
-        if self.counter <= 0:
-            self.action(*self.arguments)
-            all_timers.remove(self)
+    @property
+    def counter(self):
+        "Milliseconds left before the timer fires."
+        return self.deadline - scheduler.time
+
+    def fire(self):
+        "Internal. Call the action (the scheduler does this when the timer expires)."
+        self.fired = True
+        self.action(*self.arguments)
 
     def cancel(self):
         "Destroy the timer without firing the action."
-        if self in all_timers:
-            all_timers.remove(self)
+        scheduler.cancel(self)
+
+
+class Scheduler(object):
+    """
+    Keeps track of pending Timers in order of their deadlines. No arguments.
+
+    Time only passes when update() is called, so deadlines are in game time. Cancelled timers stay queued until they come up or there are enough of them to be worth sweeping out.
+    """
+
+    SWEEP_RATIO = 0.5   # sweep when this fraction of the queue is cancelled
+
+    def __init__(self):
+        super(Scheduler, self).__init__()
+        self.time = 0           # milliseconds of game time so far
+        self.queue = []         # heap of (deadline, sequence, timer)
+        self.sequence = 0       # keeps timers with equal deadlines in order
+        self.cancelled = 0      # cancelled timers still in the queue
+        self.total_fired = 0
+        self.last_fired = 0     # timers fired by the latest update
+
+    def schedule(self, timer, timeout):
+        "Internal. Queue a timer to fire after timeout milliseconds; returns its deadline."
+        deadline = self.time + timeout
+        heapq.heappush(self.queue, (deadline, self.sequence, timer))
+        self.sequence += 1
+        return deadline
+
+    def cancel(self, timer):
+        "Stop a timer from firing, if it hasn't already."
+        if timer.cancelled or timer.fired:
+            return
+        timer.cancelled = True
+        self.cancelled += 1
+        if self.cancelled > len(self.queue) * self.SWEEP_RATIO:
+            self.sweep()
+
+    def sweep(self):
+        "Internal. Drop cancelled timers from the queue."
+        self.queue = [entry for entry in self.queue if not entry[2].cancelled]
+        heapq.heapify(self.queue)
+        self.cancelled = 0
+
+    def update(self, loop_time):
+        "Advance the clock by loop_time milliseconds and fire any timers which have expired. Returns how many fired."
+        self.time += loop_time
+        newest = self.sequence
+        # timers created by the actions we fire wait for the next update
+        fired = 0
+        while self.queue and self.queue[0][0] <= self.time and self.queue[0][1] < newest:
+            deadline, sequence, timer = heapq.heappop(self.queue)
+            if timer.cancelled:
+                self.cancelled -= 1
+                continue
+            timer.fire()
+            fired += 1
+        self.total_fired += fired
+        self.last_fired = fired
+        return fired
+
+    def stats(self):
+        "Returns a dict of counters describing the scheduler's workload."
+        return {"time": self.time,
+                "pending": len(self.queue) - self.cancelled,
+                "cancelled": self.cancelled,
+                "fired": self.total_fired,
+                "last_fired": self.last_fired}
 
-all_timers = []
+scheduler = Scheduler()
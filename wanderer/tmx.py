@@ -0,0 +1,200 @@
+import os, base64, zlib, gzip, json, functools, numpy, pygame
+import xml.etree.cElementTree as ElementTree
+from StringIO import StringIO
+from wanderer import world
+
+CACHE_VERSION = 1
+CACHE_SUFFIX = ".npz"   # added to the .tmx filename
+GID_MASK = 0x1fffffff   # strips Tiled's flip flags from a GID
+
+# tile names in the tileset (or, failing that, layer names) to tile classes
+TILE_TYPES = {"dirt": world.DirtTile, "grass": world.GrassTile, "water": world.WaterTile}
+
+# shape words in the tileset's tile names to bitmasks; a "N" tile is the
+# northern edge of an area, so the tile is filled in to the south
+SHAPES = {"center": 0b1111, "spot": 0b0000,
+          "N": 0b0011, "S": 0b1100, "W": 0b0101, "E": 0b1010,
+          "NW": 0b0001, "NE": 0b0010, "SW": 0b0100, "SE": 0b1000,
+          "minus NW": 0b0111, "minus NE": 0b1011, "minus SW": 0b1101, "minus SE": 0b1110}
+
+
+class TiledMap(object):
+    """
+    The tile layers of a map made with Tiled, decoded into arrays. Arguments:
+        path    (filename of the .tmx file)
+
+    Each GID is turned into a kind of tile (a tile name, bitmask and whether it's walkable) using the names and "nowalk" properties in the tilesets. The first load decodes the XML and writes the arrays to a cache file beside the .tmx; later loads read that instead, until the .tmx or its tilesets are modified.
+    """
+
+    def __init__(self, path):
+        super(TiledMap, self).__init__()
+        self.path = path
+        self.width = self.height = 0
+        self.layer_names = []
+        # visible layers with known tiles, bottom-up
+        self.layers = {}
+        # layer names to numpy arrays [y, x] of indexes into kinds
+        self.kinds = [None]
+        # (tile name, bitmask, walkable); 0 means no tile
+        self.sources = {}
+        # filenames read to make the map, to their mtimes
+        if not self.load_cache():
+            self.parse()
+            self.save_cache()
+
+    @property
+    def cache_path(self):
+        return self.path + CACHE_SUFFIX
+
+    def load_cache(self):
+        "Internal. Read the map from the cache file, if there is one and it's up to date. Returns True if it was read."
+        try:
+            cache = numpy.load(self.cache_path)
+        except (IOError, OSError, ValueError):
+            return False
+        try:
+            meta = json.loads(str(cache["meta"]))
+            if meta["version"] != CACHE_VERSION:
+                return False
+            for filename, mtime in meta["sources"].items():
+                if os.path.getmtime(filename) != mtime:
+                    return False
+            self.width, self.height = meta["size"]
+            self.layer_names = meta["layer_names"]
+            self.kinds = [tuple(kind) if kind else None for kind in meta["kinds"]]
+            self.sources = meta["sources"]
+            self.layers = dict((name, cache["layer_{}".format(i)]) for i, name in enumerate(self.layer_names))
+        except (KeyError, OSError, ValueError):
+            return False
+        finally:
+            cache.close()
+        return True
+
+    def save_cache(self):
+        "Internal. Write the decoded map to the cache file, if its directory is writable."
+        meta = {"version": CACHE_VERSION, "size": (self.width, self.height), "layer_names": self.layer_names,
+                "kinds": self.kinds, "sources": self.sources}
+        arrays = dict(("layer_{}".format(i), self.layers[name]) for i, name in enumerate(self.layer_names))
+        temp_path = self.cache_path + ".tmp"
+        try:
+            cache_file = open(temp_path, "wb")
+            try:
+                numpy.savez(cache_file, meta = numpy.array(json.dumps(meta)), **arrays)
+            finally:
+                cache_file.close()
+            os.rename(temp_path, self.cache_path)
+        except (IOError, OSError):
+            # e.g. installed read-only; we'll just parse it every time
+            pass
+
+    def parse(self):
+        "Internal. Decode the map from the .tmx file and its tilesets."
+        self.sources = {self.path: os.path.getmtime(self.path)}
+        root = ElementTree.parse(self.path).getroot()
+        self.width, self.height = (int(root.get("width")), int(root.get("height")))
+        tilesets = []
+        # (first GID, {local tile id: properties})
+        for tileset in root.findall("tileset"):
+            first_gid = int(tileset.get("firstgid"))
+            if tileset.get("source"):
+                filename = os.path.join(os.path.dirname(self.path), tileset.get("source"))
+                self.sources[filename] = os.path.getmtime(filename)
+                tileset = ElementTree.parse(filename).getroot()
+            tilesets.append((first_gid, tile_properties(tileset)))
+        tilesets.sort(reverse = True)
+        kind_indexes = {}
+        for layer in root.findall("layer"):
+            if layer.get("visible") == "0":
+                continue
+            name = layer.get("name").lower()
+            gids = decode_layer(layer.find("data"), self.width, self.height)
+            unique, inverse = numpy.unique(gids, return_inverse = True)
+            indexes = []
+            for gid in unique.tolist():
+                kind = gid_kind(gid, name, tilesets)
+                if kind and not kind_indexes.has_key(kind):
+                    kind_indexes[kind] = len(self.kinds)
+                    self.kinds.append(kind)
+                indexes.append(kind_indexes.get(kind, 0))
+            kinds = numpy.array(indexes, dtype = numpy.uint16)[inverse].reshape(self.height, self.width)
+            if kinds.any():
+                self.layer_names.append(name)
+                self.layers[name] = kinds
+
+    def tiers(self, rect, layer_class = None):
+        "Return a list of one Tier holding the map's tiles within rect (in tiles), e.g. for one chunk of a world.Map."
+        if layer_class is None:
+            layer_class = world.Layer
+        layers = {}
+        for name in self.layer_names:
+            kinds = self.layers[name][rect.top:rect.bottom, rect.left:rect.right]
+            tiles = {}
+            rows, columns = numpy.nonzero(kinds)
+            for row, column, index in zip(rows.tolist(), columns.tolist(), kinds[rows, columns].tolist()):
+                tile_name, bitmask, walkable = self.kinds[index]
+                tile = TILE_TYPES[tile_name]()
+                if bitmask != tile.bitmask:
+                    tile.update(bitmask = bitmask)
+                tile.flags["walkable"] = walkable
+                tiles[(rect.left + column, rect.top + row)] = tile
+            layers[name] = layer_class(rect, tiles)
+        return [world.Tier(rect, layers, layer_class, self.layer_names)]
+
+
+def tile_properties(tileset):
+    "Return a dict of a tileset element's local tile ids to dicts of their properties."
+    tiles = {}
+    for tile in tileset.findall("tile"):
+        properties = {}
+        for prop in tile.findall("properties/property"):
+            properties[prop.get("name")] = prop.get("value")
+        tiles[int(tile.get("id"))] = properties
+    return tiles
+
+def decode_layer(data, width, height):
+    "Return a numpy array [y, x] of the GIDs in a layer's data element."
+    encoding = data.get("encoding")
+    if encoding == "csv":
+        gids = numpy.array([int(gid) for gid in data.text.split(",")], dtype = numpy.uint32)
+    elif encoding == "base64":
+        raw = base64.b64decode(data.text.strip())
+        compression = data.get("compression")
+        if compression == "zlib":
+            raw = zlib.decompress(raw)
+        elif compression == "gzip":
+            raw = gzip.GzipFile(fileobj = StringIO(raw)).read()
+        elif compression:
+            raise ValueError("Unsupported TMX layer compression: {}".format(compression))
+        gids = numpy.frombuffer(raw, dtype = "<u4")
+    else:
+        # plain XML, one <tile> per cell
+        gids = numpy.array([int(tile.get("gid", 0)) for tile in data.findall("tile")], dtype = numpy.uint32)
+    return (gids & GID_MASK).reshape(height, width)
+
+def gid_kind(gid, layer_name, tilesets):
+    "Return the (tile name, bitmask, walkable) a GID stands for on the named layer, or None for no tile."
+    if not gid:
+        return None
+    properties = {}
+    for first_gid, tiles in tilesets:
+        if gid >= first_gid:
+            properties = tiles.get(gid - first_gid, {})
+            break
+    words = properties.get("name", "").split()
+    if words and words[-1].isdigit():
+        # numbered variants look the same to us
+        words.pop()
+    if words and TILE_TYPES.has_key(words[0]):
+        tile_name, shape = (words[0], " ".join(words[1:]) or "center")
+    else:
+        tile_name, shape = (layer_name, "center")
+    if not TILE_TYPES.has_key(tile_name):
+        return None
+    return (tile_name, SHAPES.get(shape, 0b1111), properties.get("nowalk") != "1")
+
+def load_map(path, view = None, layer_class = None, **kwargs):
+    "Return a world.Map of a .tmx file, whose chunks are built from it as they're needed. Other keyword arguments are passed to the Map."
+    tiled = TiledMap(path)
+    rect = pygame.Rect(0, 0, tiled.width, tiled.height)
+    generator = functools.partial(tiled.tiers, layer_class = layer_class)
+    return world.Map(rect, layer_class = layer_class, view = view, generator = generator, source = path, **kwargs)
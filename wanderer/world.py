@@ -1,112 +1,310 @@
-import pygame, numpy, random, os, math
+import pygame, numpy, random, os, sys, math, json, collections, contextlib, functools, weakref
 from wanderer.constants import *
+from wanderer import fonts
 
 TILE_SIZE = 32
 COLOR_KEY = (0, 0, 0)
+DIRTY_RECT_LIMIT = 32   # changed tiles per update before we merge their rects
+CHUNK_SIZE = 16         # tiles along each side of a map chunk
+CHUNK_BUDGET = 64 * 1024 * 1024     # bytes of chunk surfaces to keep loaded
+LOAD_MARGIN = 4         # tiles around the view and agents to keep loaded
+WALK_SHAPE_CACHE_SIZE = 256     # walkable areas to keep for reuse
+ATLAS_DIR = os.path.join(DATA_DIR, "images", "atlas")
+ATLAS_INDEX = "tiles.json"  # in ATLAS_DIR; written by build_atlas.py
+ATLAS_VERSION = 2
+
+# where each tile image is on a tile sheet, as (column, row) in tiles
+TILE_LOCATIONS = {
+    0b1111: (1, 3),     # center
+    0b0001: (0, 2), 0b0010: (2, 2), 0b0100: (0, 4), 0b1000: (2, 4),     # corner
+    0b1110: (1, 0), 0b1101: (2, 0), 0b1011: (1, 1), 0b0111: (2, 1),     # anticorner
+    0b0011: (1, 2), 0b1010: (2, 3), 0b0101: (0, 3), 0b1100: (1, 4),     # edge
+}
+# the images for each health level of a lone (0b0000) or surrounded
+# (0b1111) tile: blank, then small and non-connecting, then dense and
+# fully connecting
+HEALTH_LOCATIONS = (None, (0, 1), (0, 0), (1, 3), (2, 5), (1, 5), (0, 5))
+
+# tile bitmask bits for each corner, with the offset (row, column) from a
+# tile's location to that corner on the grid of tile corners
+CORNERS = ((0b1000, 0, 0), (0b0100, 0, 1), (0b0010, 1, 0), (0b0001, 1, 1))
+
+# tile flags as bits, for layers which store tiles in arrays
+FLAG_BITS = {"walkable": 0b001, "superwalkable": 0b010, "immortal": 0b100}
+KILL_BIT = 0b01000000
+DIRTY_BIT = 0b10000000
+# the arrays an ArrayLayer keeps (and Layer.to_arrays returns), and their types
+ARRAY_FIELDS = (("types", numpy.uint16), ("masks", numpy.uint8), ("health", numpy.uint8), ("flags", numpy.uint8))
 
 
 class Map(object):
-    "Stores data about the map. Initialize with pygame.Rect defining size/offset in tiles."
+    """
+    Stores data about the map, split into square Chunks. Arguments:
+        rect        (pygame.Rect defining size/offset of the whole map in tiles)
+        tiers       (optional: list of Tiers covering the whole map, for maps
+                     saved before chunking; they become a single chunk)
+        layer_class (optional: Layer class to build new chunks' layers with)
+        chunk_size  (optional: tiles along each side of a chunk)
+        stored      (optional: dict of chunk coordinates to Chunk.to_json or
+                     Chunk.pack output, for chunks to load when they're needed)
+        view        (optional: pygame.Rect of the map area drawn on the
+                     surface, in pixels; defaults to the whole map)
+        generator   (optional: function taking a chunk's rect in tiles and
+                     returning a list of Tiers for it; defaults to the
+                     standard terrain)
+        source      (optional: filename the generator reads the map from,
+                     e.g. a .tmx file, saved so loading can regenerate from it)
+
+    Chunks are loaded (or generated) as the view or the active areas passed to update() come near them. Once the loaded chunks' surfaces take up more than budget bytes, the ones idle longest are stored away again. Tile and pixel coordinates are always for the whole map.
+    """
 
-    def __init__(self, rect, tiers=None):
+    def __init__(self, rect, tiers = None, layer_class = None, chunk_size = CHUNK_SIZE, stored = None, view = None, generator = None, source = None):
         self.rect = rect
         self.left, self.top, self.width, self.height = self.rect
-        px_width, px_height = (self.width*TILE_SIZE, self.height*TILE_SIZE)
-        self.surface = pygame.Surface((px_width, px_height))
+        self.layer_class = layer_class
+        self.generator = generator
+        self.source = source
+        if tiers:
+            chunk_size = max(self.width, self.height)
+        self.chunk_size = chunk_size
+        self.chunks = {}
+        # chunk coordinates to loaded Chunks
+        if stored is None:
+            stored = {}
+        self.stored = stored
+        # chunk coordinates to Chunk.to_json or Chunk.pack output, for chunks not loaded
+        self.budget = CHUNK_BUDGET
+        self.loaded_bytes = 0
+        # roughly how much memory the loaded chunks take up
+        self.clock = 0
+        # updates so far; chunks note when they were last needed
+        self.edits = {}
+        # (tier index, layer name, x, y) to the layer, for locations whose
+        # tiles were stored or removed since the journal last looked
+
+        self.px_rect = pygame.Rect(self.left*TILE_SIZE, self.top*TILE_SIZE, self.width*TILE_SIZE, self.height*TILE_SIZE)
+        if view is None:
+            view = self.px_rect.copy()
+        self.view = view
+        self.surface = pygame.Surface(self.view.size)
         self.surface.set_colorkey(COLOR_KEY)
-        self.dirty = True
+        self.dirty_rects = [self.surface.get_rect()]
+        # areas of the surface changed since they were last displayed
 
         if tiers:
-            self.tiers = tiers
-        else:
-            self.tiers = [Tier(self.rect)]
-
-        self.tile_masks = {}
-        self.walk_mask = pygame.sprite.Sprite()
-        self.walk_mask.image = pygame.Surface((px_width, px_height))
-        self.walk_mask.image.set_colorkey(COLOR_KEY)
-        self.walk_mask.rect = self.surface.get_rect()
-
+            self.add_chunk((0, 0), Chunk(self.rect, tiers))
         self.update()
 
     def to_json(self):
-        return {'rect': tuple(self.rect), 'tiers': [t.to_json() for t in self.tiers]}
+        chunks = [chunk.to_json() for chunk in self.chunks.values()]
+        for json_chunk in self.stored.values():
+            if json_chunk.get("packed"):
+                # its layers are still arrays
+                json_chunk = Chunk.from_json(json_chunk).to_json()
+            chunks.append(json_chunk)
+        layer_class = self.layer_class or Layer
+        json_map = {'rect': tuple(self.rect), 'chunk_size': self.chunk_size, 'layer_type': layer_class.__name__, 'chunks': chunks}
+        if self.source:
+            json_map['source'] = self.source
+        return json_map
 
     @classmethod
-    def from_json(self, json_map):
-        return Map(pygame.Rect(*json_map["rect"]), [Tier.from_json(t) for t in json_map["tiers"]])
+    def from_json(self, json_map, view = None):
+        rect = pygame.Rect(*json_map["rect"])
+        if json_map.has_key("tiers"):
+            # saved before the map was split into chunks
+            return Map(rect, [Tier.from_json(t) for t in json_map["tiers"]], view = view)
+        layer_class = globals()[json_map.get("layer_type", "Layer")]
+        return Map.from_chunks(rect, json_map["chunks"], layer_class, json_map["chunk_size"], view, json_map.get("source"))
 
-    def update(self):
-        for tier in self.tiers:
-            tier.update()
-            if tier.dirty:
-                self.dirty = True
-                tier.dirty = False
-            self.surface.blit(tier.surface, (0,0))
+    @classmethod
+    def from_chunks(self, rect, json_chunks, layer_class = None, chunk_size = CHUNK_SIZE, view = None, source = None):
+        "Return a Map which loads the given Chunk.to_json outputs when they're needed, and generates any other chunks (from the source map, if there is one)."
+        stored = {}
+        for json_chunk in json_chunks:
+            left, top = json_chunk["rect"][:2]
+            stored[((left - rect.left) / chunk_size, (top - rect.top) / chunk_size)] = json_chunk
+        if source:
+            # chunks which were never loaded still come from the source map
+            from wanderer import tmx
+            return tmx.load_map(source, view = view, layer_class = layer_class, chunk_size = chunk_size, stored = stored)
+        return Map(rect, layer_class = layer_class, chunk_size = chunk_size, stored = stored, view = view)
+
+    def update(self, active = ()):
+        "Load the chunks near the view and any active pixel rects given (e.g. agents' sprites), recomposite tile locations which changed in view, note their areas in dirty_rects, and evict idle chunks over budget."
+        self.clock += 1
+        margin = 2 * LOAD_MARGIN * TILE_SIZE
+        for area in [self.view] + list(active):
+            for chunk in self.chunks_in(area.inflate(margin, margin)):
+                chunk.last_used = self.clock
+        redrawn = set()
+        for chunk in self.chunks.values():
+            chunk.update()
+            redrawn.update(chunk.redrawn)
+            chunk.redrawn.clear()
+        surface_rect = self.surface.get_rect()
+        changed = []
+        for x, y in redrawn:
+            rect = pygame.Rect(x*TILE_SIZE - self.view.x, y*TILE_SIZE - self.view.y, TILE_SIZE, TILE_SIZE).clip(surface_rect)
+            if not rect:
+                continue
+            self.draw_area(self.chunks[self.chunk_key(x, y)], rect)
+            changed.append(rect)
+        if len(changed) > DIRTY_RECT_LIMIT:
+            changed = [changed[0].unionall(changed)]
+        self.dirty_rects.extend(changed)
+        self.evict()
+
+    def move_view(self, px_x, px_y):
+        "Move the top left of the view to the given map pixel coordinates, and redraw the parts of the surface which come into view."
+        dx, dy = (px_x - self.view.x, px_y - self.view.y)
+        if not dx and not dy:
+            return
+        self.view.topleft = (px_x, px_y)
+        surface_rect = self.surface.get_rect()
+        width, height = surface_rect.size
+        if abs(dx) >= width or abs(dy) >= height:
+            exposed = [surface_rect]
+        else:
+            self.surface.scroll(-dx, -dy)
+            exposed = []
+            if dx > 0:
+                exposed.append(pygame.Rect(width - dx, 0, dx, height))
+            elif dx < 0:
+                exposed.append(pygame.Rect(0, 0, -dx, height))
+            if dy > 0:
+                exposed.append(pygame.Rect(0, height - dy, width, dy))
+            elif dy < 0:
+                exposed.append(pygame.Rect(0, 0, width, -dy))
+        for rect in exposed:
+            self.surface.fill(COLOR_KEY, rect)
+            for chunk in self.chunks_in(rect.move(self.view.topleft)):
+                chunk_rect = pygame.Rect(chunk.left*TILE_SIZE, chunk.top*TILE_SIZE, chunk.width*TILE_SIZE, chunk.height*TILE_SIZE)
+                self.draw_area(chunk, rect.clip(chunk_rect.move(-self.view.x, -self.view.y)))
+        self.dirty_rects = [surface_rect]
+
+    def draw_area(self, chunk, rect):
+        "Internal. Redraw an area of the surface from one chunk."
+        area = rect.move(self.view.x - chunk.left*TILE_SIZE, self.view.y - chunk.top*TILE_SIZE)
+        self.surface.fill(COLOR_KEY, rect)
+        for tier in chunk.tiers:
             # blit all of them, in case a higher tier updated to transparent
-        for x in xrange(self.width):
-            for y in xrange(self.height):
-                mask = self.get_tile_mask(x, y)
-                self.walk_mask.image.blit(mask, (x*TILE_SIZE, y*TILE_SIZE))
-        self.walk_mask.image.set_alpha(100)
-        self.surface.blit(self.walk_mask.image, (0, 0))
+            self.surface.blit(tier.surface, rect, area)
+        self.surface.blit(chunk.walk_image, rect, area)
         # ^ extremely useful for collision debugging
 
+    def chunk_key(self, x, y):
+        "Internal. Return the coordinates of the chunk holding tile location x, y."
+        return ((x - self.left) / self.chunk_size, (y - self.top) / self.chunk_size)
+
+    def chunk_at(self, x, y):
+        "Return the Chunk holding tile location x, y, loading it if need be, or None if it's off the map."
+        if not self.rect.collidepoint(x, y):
+            return None
+        return self.load_chunk(self.chunk_key(x, y))
+
+    def chunks_in(self, px_rect):
+        "Return a list of the chunks overlapping a pixel rect, loading them if need be."
+        area = px_rect.clip(self.px_rect)
+        if not area:
+            return []
+        px_x, px_y = self.px_rect.topleft
+        chunk_px_size = self.chunk_size * TILE_SIZE
+        left, top = ((area.left - px_x) / chunk_px_size, (area.top - px_y) / chunk_px_size)
+        right, bottom = ((area.right - 1 - px_x) / chunk_px_size, (area.bottom - 1 - px_y) / chunk_px_size)
+        if left == right and top == bottom:
+            return [self.chunks.get((left, top)) or self.load_chunk((left, top))]
+        return [self.load_chunk((cx, cy)) for cx in xrange(left, right + 1) for cy in xrange(top, bottom + 1)]
+
+    def load_chunk(self, key):
+        "Internal. Return the chunk with the given coordinates, loading or generating it if it isn't loaded."
+        chunk = self.chunks.get(key)
+        if chunk:
+            return chunk
+        if self.stored.has_key(key):
+            chunk = Chunk.from_json(self.stored.pop(key))
+        else:
+            cx, cy = key
+            rect = pygame.Rect(self.left + cx*self.chunk_size, self.top + cy*self.chunk_size, self.chunk_size, self.chunk_size).clip(self.rect)
+            if self.generator:
+                chunk = Chunk(rect, self.generator(rect))
+            else:
+                chunk = Chunk(rect, [Tier(rect, generate_layers(rect, self.rect, self.layer_class), self.layer_class)])
+        for tier in chunk.tiers:
+            for layer in tier.layers.values():
+                # they already match their neighbors; just draw them
+                for x, y in layer.pending:
+                    layer.settle(x, y)
+        self.add_chunk(key, chunk)
+        return chunk
+
+    def add_chunk(self, key, chunk):
+        "Internal. Keep a chunk loaded, and let its layers reach into the chunks around it."
+        for index, tier in enumerate(chunk.tiers):
+            for name, layer in tier.layers.items():
+                layer.find_layer = functools.partial(self.find_layer, index, name)
+                layer.on_edit = functools.partial(self.note_edit, index, name, layer)
+        chunk.last_used = self.clock
+        self.chunks[key] = chunk
+        self.loaded_bytes += chunk.size()
+
+    def find_layer(self, tier_index, name, x, y):
+        "Internal. Return the named layer in the given tier of whichever chunk holds location x, y, or None if it's off the map."
+        chunk = self.chunk_at(x, y)
+        if chunk:
+            return chunk.tiers[tier_index].layers.get(name)
+        return None
+
+    def note_edit(self, tier_index, name, layer, x, y):
+        "Internal. Remember that a layer of a loaded chunk stored or removed the tile at x, y (see Layer.on_edit)."
+        self.edits[(tier_index, name, x, y)] = layer
+
+    def evict(self):
+        "Internal. Store away the chunks idle longest until the loaded ones fit within budget."
+        if self.loaded_bytes <= self.budget:
+            return
+        idle = sorted((chunk.last_used, key) for key, chunk in self.chunks.items() if chunk.last_used < self.clock)
+        for last_used, key in idle:
+            chunk = self.chunks.pop(key)
+            for tier in chunk.tiers:
+                for layer in tier.layers.values():
+                    layer.find_layer = None
+                    layer.on_edit = None
+            self.stored[key] = chunk.pack()
+            self.loaded_bytes -= chunk.size()
+            if self.loaded_bytes <= self.budget:
+                break
+
     def walkable_coords(self, px_x, px_y):
         "Returns True if the pixel at the coordinates given is walkable, False otherwise."
-        pixel = self.walk_mask.image.get_at((px_x, px_y))[0:3]
-        if pixel == COLOR_KEY:
+        chunk = self.chunk_at(px_x/TILE_SIZE, px_y/TILE_SIZE)
+        if chunk is None or chunk.walkable_coords(px_x, px_y):
             return True
         return False
 
     def walkable_mask(self, sprite):
-        "Takes a sprite (with .image and .rect attributes), and returns True if all opaque parts of the sprite are over walkable map areas."
-        if pygame.sprite.collide_mask(sprite, self.walk_mask):
-            return False
+        "Takes a sprite (with .image and .rect attributes, and optionally .mask), and returns True if all opaque parts of the sprite are over walkable map areas."
+        mask = getattr(sprite, "mask", None)
+        if mask is None:
+            mask = pygame.mask.from_surface(sprite.image)
+        px_x, px_y = sprite.rect.topleft
+        for chunk in self.chunks_in(sprite.rect):
+            if chunk.walk_mask.overlap(mask, (px_x - chunk.left*TILE_SIZE, px_y - chunk.top*TILE_SIZE)):
+                return False
         return True
 
-    def get_tile_mask(self, x, y):
-        "Returns a pygame.Surface whose colorkey transparency values match the walkable status of the terrain at the given tile location. Caches these masks."
-        if not self.tile_masks.has_key((x, y)):
-            if COLOR_KEY == (0, 0, 0):
-                new_color_key = (255, 255, 255)
-            else:
-                new_color_key = (0, 0, 0)
-            tile_mask = pygame.Surface((TILE_SIZE, TILE_SIZE))
-            tile_mask.set_colorkey(COLOR_KEY)
-            for tile in self.tiles_under(x, y):
-                if tile and not tile.flags.get("superwalkable"):
-                    if tile.flags.get("walkable"):
-                        tile_mask.blit(tile.image, (0,0))
-                    else:
-                        tile_mask.fill(COLOR_KEY)
-            # modified from source of pygame.surfarray.array_color_key
-            # which turned out to be easier than just using it
-            key_int = tile_mask.map_rgb(COLOR_KEY)
-            new_key_int = tile_mask.map_rgb(new_color_key)
-            mask_array = pygame.surfarray.pixels2d(tile_mask)
-            mask_array = numpy.choose(numpy.equal(mask_array, key_int), (key_int, new_key_int))
-            mask_array.shape = TILE_SIZE, TILE_SIZE
-            tile_mask = pygame.surfarray.make_surface(mask_array)
-            tile_mask.set_colorkey(COLOR_KEY)
-            self.tile_masks[(x, y)] = tile_mask
-        return self.tile_masks[(x, y)]
-
     def top_tier(self, x, y):
-        for tier in reversed(self.tiers):
-            if tier.exists_at(x, y):
-                return tier
+        chunk = self.chunk_at(x, y)
+        if chunk:
+            return chunk.top_tier(x, y)
         return None
 
     def tiles_under(self, x, y):
         "Returns a list of tiles on the top tier under the coordinates given, from bottom layer to top."
-        tiles = []
-        tier = self.top_tier(x, y)
-        if tier:
-            for name in tier.layer_names:
-                tile = tier.layers[name].get_tile(x, y)
-                tiles.append(tile)
-        return tiles
+        chunk = self.chunk_at(x, y)
+        if chunk:
+            return chunk.tiles_under(x, y)
+        return []
 
     def top_tile(self, x, y):
         "Returns the top tile which exists under the coordinates given, or None if there aren't any."
@@ -117,12 +315,12 @@ class Map(object):
         return tile
 
     def place(self, px_x, px_y, item):
-        "Attempt to place the given item on the top tile at the given coordinates."
+        "Attempt to place the given item on the top tile at the given map pixel coordinates."
         x, y = (px_x/TILE_SIZE, px_y/TILE_SIZE)
         return item.alter_tiles(self.top_tier(x, y), x, y)
 
     def pick_up(self, px_x, px_y):
-        "Attempt to pick up the top tile at the given coordinates."
+        "Attempt to pick up the top tile at the given map pixel coordinates."
         x, y = (px_x/TILE_SIZE, px_y/TILE_SIZE)
         tile = self.top_tile(x, y)
         if tile:
@@ -130,32 +328,160 @@ class Map(object):
         return None
 
 
+class Chunk(object):
+    "A square of the map, with its own tiers and walkability data. Initialize with pygame.Rect defining size/offset in tiles, and a list of Tiers covering it."
+
+    def __init__(self, rect, tiers):
+        self.rect = rect
+        self.left, self.top, self.width, self.height = self.rect
+        px_width, px_height = (self.width*TILE_SIZE, self.height*TILE_SIZE)
+        self.tiers = tiers
+        self.redrawn = set()
+        # tile locations redrawn since the map last looked
+        self.last_used = 0
+        # the map's clock when the chunk was last near anything
+
+        # set bits in walk_mask are not walkable; locations start out
+        # unwalkable and are opened up as their tiles are drawn
+        self.walk_mask = pygame.mask.Mask((px_width, px_height))
+        self.walk_mask.fill()
+        self.tile_mask = pygame.mask.Mask((TILE_SIZE, TILE_SIZE))
+        self.tile_mask.fill()
+        self.walk_image = pygame.Surface((px_width, px_height))
+        self.walk_image.fill((255, 255, 255))
+        self.walk_image.set_colorkey(COLOR_KEY)
+        self.walk_image.set_alpha(100)
+
+    def __repr__(self):
+        return "<Chunk:{}>".format(tuple(self.rect))
+
+    def to_json(self):
+        return {'rect': tuple(self.rect), 'tiers': [t.to_json() for t in self.tiers]}
+
+    def pack(self):
+        "Return the chunk like to_json() does, but with each layer's tiles as arrays (see Layer.to_arrays); from_json() reads either."
+        tiers = []
+        for tier in self.tiers:
+            layers = {}
+            for name, layer in tier.layers.items():
+                layers[name] = {'type': layer.__class__.__name__, 'rect': tuple(layer.rect), 'arrays': layer.to_arrays()}
+            tiers.append({'rect': tuple(tier.rect), 'layer_names': tier.layer_names, 'layers': layers})
+        return {'rect': tuple(self.rect), 'tiers': tiers, 'packed': True}
+
+    @classmethod
+    def from_json(self, json_chunk):
+        return Chunk(pygame.Rect(*json_chunk["rect"]), [Tier.from_json(t) for t in json_chunk["tiers"]])
+
+    def update(self):
+        "Update the chunk's tiers, and the walkability of any tile locations which changed."
+        redrawn = set()
+        for tier in self.tiers:
+            tier.update()
+            redrawn.update(tier.redrawn)
+            tier.redrawn.clear()
+        for x, y in redrawn:
+            if self.rect.collidepoint(x, y):
+                self.update_walkable(x, y)
+                self.redrawn.add((x, y))
+
+    def size(self):
+        "Returns roughly how many bytes the chunk's surfaces take up."
+        surfaces = [self.walk_image]
+        for tier in self.tiers:
+            surfaces.append(tier.surface)
+            surfaces.extend(layer.surface for layer in tier.layers.values())
+        return sum(s.get_bytesize() * s.get_width() * s.get_height() for s in surfaces)
+
+    def update_walkable(self, x, y):
+        "Recalculate the walkable area of the tile location given, after its tiles have changed."
+        tile_mask, mask = self.walk_shape(x, y)
+        px_x, px_y = ((x - self.left)*TILE_SIZE, (y - self.top)*TILE_SIZE)
+        self.walk_mask.erase(self.tile_mask, (px_x, px_y))
+        self.walk_mask.draw(mask, (px_x, px_y))
+        self.walk_image.fill(COLOR_KEY, (px_x, px_y, TILE_SIZE, TILE_SIZE))
+        self.walk_image.blit(tile_mask, (px_x, px_y))
+
+    def walkable_coords(self, px_x, px_y):
+        "Returns True if the map pixel at the coordinates given is walkable, False otherwise."
+        if self.walk_mask.get_at((px_x - self.left*TILE_SIZE, px_y - self.top*TILE_SIZE)):
+            return False
+        return True
+
+    def get_tile_mask(self, x, y):
+        "Returns a pygame.Surface whose colorkey transparency values match the walkable status of the terrain at the given tile location. It's shared with other locations, so don't modify it."
+        return self.walk_shape(x, y)[0]
+
+    def walk_shape(self, x, y):
+        """
+        Internal. Returns the walkable area of the tile location given, as a (pygame.Surface, pygame.mask.Mask) pair.
+
+        Most locations are covered by the same few combinations of tile images, so the pair is worked out once for each combination and shared.
+        """
+        key = []
+        for tile in self.tiles_under(x, y):
+            if tile and not tile.flags.get("superwalkable"):
+                if tile.flags.get("walkable"):
+                    key.append(tile.image)
+                else:
+                    # covers up everything below it
+                    key = [None]
+        key = tuple(key)
+        shape = walk_shapes.pop(key, None)
+        if shape is None:
+            tile_mask = make_tile_mask(key)
+            shape = (tile_mask, pygame.mask.from_surface(tile_mask))
+            if len(walk_shapes) >= WALK_SHAPE_CACHE_SIZE:
+                walk_shapes.popitem(last = False)
+                # least recently used
+        walk_shapes[key] = shape
+        return shape
+
+    def top_tier(self, x, y):
+        for tier in reversed(self.tiers):
+            if tier.exists_at(x, y):
+                return tier
+        return None
+
+    def tiles_under(self, x, y):
+        "Returns a list of tiles on the top tier under the coordinates given, from bottom layer to top."
+        tiles = []
+        tier = self.top_tier(x, y)
+        if tier:
+            for name in tier.layer_names:
+                tile = tier.layers[name].get_tile(x, y)
+                tiles.append(tile)
+        return tiles
+
+
 class Tier(object):
-    "Stores information about a height level on the map. Initialize with width and height in tiles."
+    "Stores information about a height level on the map. Initialize with width and height in tiles, and optionally the Layer class to make its layers with and the names of its layers, bottom-up."
 
-    def __init__(self, rect, layers = None):
+    def __init__(self, rect, layers = None, layer_class = None, layer_names = None):
         self.rect = rect
         self.left, self.top, self.width, self.height = self.rect
         px_width, px_height = (self.width*TILE_SIZE, self.height*TILE_SIZE)
         self.surface = pygame.Surface((px_width, px_height))
-        self.dirty = True
+        self.surface.set_colorkey(COLOR_KEY)
+        self.redrawn = set()
+        # tile locations redrawn since the map last looked
 
         # the name list defines the order of the layers, bottom-up
-        self.layer_names = ["dirt", "grass", "water"]
+        if layer_names is None:
+            layer_names = ["dirt", "grass", "water"]
+        self.layer_names = list(layer_names)
+        if layer_class is None:
+            layer_class = Layer
         if layers is None:
-            layers = {}
-            layers["dirt"] = Layer(self.rect).fill(DirtTile)
-            layers["grass"] = Layer(self.rect).set_rect((2, 2), (self.width-2, self.height-2), GrassTile)
-            layers["water"] = Layer(self.rect).set_rect((4, 4), (self.width-4, self.height-4), WaterTile)
+            layers = generate_layers(self.rect, self.rect, layer_class)
         self.layers = layers
         for name in self.layer_names:
             if not self.layers.get(name):
-                self.layers[name] = Layer(self.rect)
+                self.layers[name] = layer_class(self.rect)
 
     def __repr__(self):
         layers = []
         for name in self.layer_names:
-            layers.append("{}({})".format(name, len(self.layers[name].tiles)))
+            layers.append("{}({})".format(name, self.layers[name].count()))
         layer_text = ",".join(layers)
         return "<Tier:{}>".format(layer_text)
 
@@ -163,25 +489,44 @@ class Tier(object):
         layers = {}
         for name, layer in self.layers.items():
             layers[name] = layer.to_json()
-        return {'rect': tuple(self.rect), 'layers': layers}
+        return {'rect': tuple(self.rect), 'layers': layers, 'layer_names': self.layer_names}
 
     @classmethod
     def from_json(self, json_tier):
         layers = {}
         for name, layer in json_tier["layers"].items():
-            layers[name] = Layer.from_json(layer)
-        return Tier(pygame.Rect(*json_tier["rect"]), layers)
+            layers[name] = globals()[layer.get("type", "Layer")].from_json(layer)
+        return Tier(pygame.Rect(*json_tier["rect"]), layers, layer_names = json_tier.get("layer_names"))
 
 
     def update(self):
-        "Redraw the tier surface."
+        "Redraw the tier surface wherever any of its layers changed."
+        redrawn = set()
         for name in self.layer_names:
             layer = self.layers[name]
             layer.update()
-            if layer.dirty:
-                self.dirty = True
-                layer.dirty = False
-            self.surface.blit(layer.surface, layer.rect)
+            redrawn.update(layer.redrawn)
+            layer.redrawn.clear()
+        for x, y in redrawn:
+            px_x = (x - self.left) * TILE_SIZE
+            px_y = (y - self.top) * TILE_SIZE
+            self.surface.fill(COLOR_KEY, (px_x, px_y, TILE_SIZE, TILE_SIZE))
+            for name in self.layer_names:
+                layer = self.layers[name]
+                area = ((x - layer.left) * TILE_SIZE, (y - layer.top) * TILE_SIZE, TILE_SIZE, TILE_SIZE)
+                self.surface.blit(layer.surface, (px_x, px_y), area)
+        self.redrawn.update(redrawn)
+
+    @contextlib.contextmanager
+    def batch(self):
+        "Context manager which batches edits to all the tier's layers (see Layer.batch)."
+        for layer in self.layers.values():
+            layer.begin()
+        try:
+            yield self
+        finally:
+            for layer in self.layers.values():
+                layer.commit()
 
     def exists_at(self, x, y):
         "Return True if the tier has contents at the given coordinates."
@@ -192,58 +537,231 @@ class Tier(object):
         return exists
 
 
+def generate_layers(rect, map_rect, layer_class = None):
+    "Return a dict of layer names to new layers covering rect (in tiles), filled in with the default terrain for a map covering map_rect."
+    if layer_class is None:
+        layer_class = Layer
+    terrain = (("dirt", DirtTile, 0), ("grass", GrassTile, 2), ("water", WaterTile, 4))
+    # (how far each layer's tiles are inset from the edge of the map)
+    if rect == map_rect:
+        area = rect
+    else:
+        # lay out a tile further all round, so the edges autotile as they
+        # would if the whole map was built at once, then trim that off
+        area = rect.inflate(2, 2)
+    layers = {}
+    for name, tile_type, inset in terrain:
+        layer = layer_class(area)
+        filled = map_rect.inflate(-2*inset, -2*inset).clip(area)
+        if filled:
+            layer.set_rect(filled.topleft, filled.bottomright, tile_type)
+        if area != rect:
+            tiles = {}
+            for x, y in layer.locations():
+                if rect.collidepoint(x, y):
+                    tiles[(x, y)] = layer.get_tile(x, y)
+            layer = layer_class(rect, tiles)
+        layers[name] = layer
+    return layers
+
+
 class Layer(object):
     "Stores a grid of tile objects and a surface which depicts them. Initialize with width and height in tiles."
 
     def __init__(self, rect, tiles = None):
         self.rect = rect
         self.left, self.top, self.width, self.height = self.rect
-        if tiles is None:
-            tiles = {}
-        self.tiles = tiles
+        self.tiles = {}
+        self.pending = set()
+        # tile locations which may need redrawing on the next update
+        self.redrawn = set()
+        # tile locations redrawn since the tier last looked
+        self.settled = {}
+        # pending tile locations whose neighbors already match them, to
+        # the tile's (bitmask, kill) at the time
+        self.batch_depth = 0
+        self.batch_edits = {}
+        # location to tile (or None), for edits waiting on commit()
+        self.find_layer = None
+        # if the layer is part of a map chunk, a function which takes a
+        # location outside it and returns the layer there (or None)
+        self.on_edit = None
+        # if the layer is part of a map chunk, a function called with the
+        # location of each tile stored or removed (or changed by itself)
+        if tiles:
+            for location, tile in tiles.items():
+                x, y = location
+                self.put_tile(x, y, tile)
         px_size = (self.width*TILE_SIZE, self.height*TILE_SIZE)
-        px_topleft = (self.left*TILE_SIZE, self.top*TILE_SIZE)
         self.surface = pygame.Surface(px_size)
         self.surface.set_colorkey(COLOR_KEY)
-        self.dirty = False
 
     def to_json(self):
         tiles = []
-        for location, tile in self.tiles.items():
+        for location in self.locations():
             x, y = location
-            tiles.append((x, y, tile.to_json()))
-        return {'rect': tuple(self.rect), 'tiles': tiles}
+            tiles.append((x, y, self.stored_tile(x, y).to_json()))
+        return {'type': self.__class__.__name__, 'rect': tuple(self.rect), 'tiles': tiles}
 
     @classmethod
     def from_json(self, json_layer):
+        if json_layer.has_key("arrays"):
+            return self.from_arrays(pygame.Rect(*json_layer["rect"]), json_layer["arrays"])
         tiles = {}
         for tile_tuple in json_layer["tiles"]:
             x, y, tile_json = tile_tuple
             tile_type = tile_json["type"]
             tiles[(int(x), int(y))] = globals()[tile_type].from_json(tile_json)
-        return Layer(pygame.Rect(*json_layer["rect"]), tiles)
+        return self(pygame.Rect(*json_layer["rect"]), tiles)
+
+    def to_arrays(self):
+        "Return a dict of NumPy arrays of the tiles' type ids (see tile_type_id), bitmasks, health and flags, laid out as an ArrayLayer keeps them."
+        shape = (self.height + 1, self.width + 1)
+        arrays = dict((field, numpy.zeros(shape, dtype)) for field, dtype in ARRAY_FIELDS)
+        if not self.tiles:
+            return arrays
+        locations, tiles = zip(*self.tiles.items())
+        columns, rows = zip(*locations)
+        index = (numpy.array(rows) - self.top, numpy.array(columns) - self.left)
+        arrays["types"][index] = [tile_type_id(tile.__class__, tile.name) for tile in tiles]
+        arrays["masks"][index] = [tile.bitmask for tile in tiles]
+        arrays["health"][index] = [tile.health for tile in tiles]
+        arrays["flags"][index] = [flag_bits(tile.flags) for tile in tiles]
+        return arrays
+
+    @classmethod
+    def from_arrays(self, rect, arrays):
+        "Return a new layer covering rect, holding the tiles described by a dict of arrays like to_arrays() returns."
+        types, masks, health, flags = [arrays[field] for field, dtype in ARRAY_FIELDS]
+        left, top = rect.topleft
+        tiles = {}
+        rows, columns = numpy.nonzero(types)
+        for row, column in zip(rows.tolist(), columns.tolist()):
+            tile_class, name = tile_types[types[row, column]]
+            tiles[(left + column, top + row)] = tile_class(name = name, bitmask = int(masks[row, column]),
+                health = int(health[row, column]), flags = flag_dict(flags[row, column]))
+        return self(rect, tiles)
 
     def get_tile(self, x, y):
         "Return the tile at position x, y or None if there is none."
-        if self.tiles.has_key((x, y)):
-            return self.tiles[(x, y)]
-        return None
+        if self.batch_edits.has_key((x, y)):
+            return self.batch_edits[(x, y)]
+        return self.stored_tile(x, y)
+
+    def count(self):
+        "Return how many tiles the layer holds."
+        return len(self.tiles)
+
+    def locations(self):
+        "Return a list of the locations which hold tiles."
+        return self.tiles.keys()
+
+    def changed(self, x, y):
+        "Note that the tile at x, y changed by itself, so it needs redrawing and its neighbors need updating."
+        tile = self.stored_tile(x, y)
+        if tile:
+            self.sync_tile(x, y, tile)
+        self.pending.add((x, y))
+        self.settled.pop((x, y), None)
+        if self.on_edit:
+            self.on_edit(x, y)
+
+    def owner(self, x, y):
+        "Internal. Return the layer which holds location x, y: this one, a neighboring chunk's, or None if it's off the edge."
+        if self.find_layer and not self.rect.collidepoint(x, y):
+            return self.find_layer(x, y)
+        if x < self.left or x > self.left+self.width\
+         or y < self.top or y > self.top+self.height:
+            return None
+        return self
+
+    def outside(self, left, top, width, height):
+        "Internal. Return a list of the locations in an area which aren't within the layer's rect."
+        locations = []
+        for y in xrange(top, top + height):
+            if self.top <= y < self.top + self.height:
+                columns = range(left, min(self.left, left + width)) + range(max(self.left + self.width, left), left + width)
+            else:
+                columns = range(left, left + width)
+            locations.extend((x, y) for x in columns)
+        return locations
+
+    def stored_tile(self, x, y):
+        "Internal. Return the tile stored at x, y, ignoring any batched edits, or None."
+        return self.tiles.get((x, y))
+
+    def sync_tile(self, x, y, tile):
+        "Internal. Called after attributes of the tile stored at x, y are changed directly; layers which keep copies of tile data should refresh them here."
+        pass
+
+    def pop_tile(self, x, y):
+        "Internal. Remove the tile stored at x, y without touching its neighbors."
+        tile = self.tiles.pop((x, y))
+        tile.layer = None
+        if self.on_edit:
+            self.on_edit(x, y)
+
+    def bitmasks(self, left, top, width, height):
+        "Internal. Return a NumPy array of the bitmasks of tiles stored in an area, indexed [y, x] from its top left; empty locations are 0."
+        masks = numpy.zeros((height, width), numpy.uint8)
+        for y in xrange(top, top + height):
+            for x in xrange(left, left + width):
+                tile = self.tiles.get((x, y))
+                if tile:
+                    masks[y - top, x - left] = tile.bitmask
+        return masks
+
+    def put_tile(self, x, y, tile):
+        "Internal. Store a tile at x, y without touching its neighbors."
+        old_tile = self.tiles.get((x, y))
+        if old_tile and old_tile is not tile:
+            old_tile.layer = None
+        self.tiles[(x, y)] = tile
+        tile.layer = self
+        tile.location = (x, y)
+        if tile.dirty or tile.kill:
+            self.pending.add((x, y))
+        if self.on_edit:
+            self.on_edit(x, y)
+
+    def restore_tile(self, x, y, tile):
+        "Put back the tile (or None) which x, y held when it was saved, without touching its neighbors; they're restored separately."
+        if not tile:
+            tile = self.stored_tile(x, y)
+            if not tile:
+                return
+            tile.kill = True
+            self.sync_tile(x, y, tile)
+            self.pending.add((x, y))
+        else:
+            self.put_tile(x, y, tile)
+        self.settle(x, y)
+
+    def settle(self, x, y):
+        "Internal. Note that the tile at x, y matches its neighbors as it is now, so update() needn't update them again unless it changes."
+        tile = self.stored_tile(x, y)
+        if tile:
+            self.settled[(x, y)] = (tile.bitmask, tile.kill)
 
     def set_tile(self, x, y, tile):
         "Change x, y to the given tile or None (remove it)."
+        if self.batch_depth:
+            self.batch_edits[(x, y)] = tile
+            return
         if tile:
             new_tile = tile
-            self.tiles[(x, y)] = new_tile
+            self.put_tile(x, y, new_tile)
         else:
             if self.get_tile(x, y):
                 # unsetting a tile, clear its neighbors
                 new_tile = self.get_tile(x, y)
                 new_tile.bitmask = 0
                 new_tile.kill = True
+                self.sync_tile(x, y, new_tile)
             else:
                 # unsetting a tile which didn't exist
                 return
-        self.dirty = True
+        self.pending.add((x, y))
 
         bit_changes = []
         # the elements of a tuple in bit_changes are:
@@ -266,10 +784,10 @@ class Layer(object):
 
         for translation, mask, shift in bit_changes:
             dx, dy = translation
-            if x+dx < self.left or x+dx > self.left+self.width\
-             or y+dy < self.top or y+dy > self.top+self.height:
+            layer = self.owner(x+dx, y+dy)
+            if layer is None:
                 continue
-            neighbor = self.get_tile(x+dx, y+dy)
+            neighbor = layer.get_tile(x+dx, y+dy)
             if not neighbor:
                 # there isn't already a tile there; start one
                 neighbor = new_tile.get_another(bitmask = 0)
@@ -283,27 +801,143 @@ class Layer(object):
                 neighbor.update(health = 0)
             else:
                 # place our maybe-newly-created tile
-                self.tiles[(x+dx, y+dy)] = neighbor
+                layer.put_tile(x+dx, y+dy, neighbor)
+            layer.settle(x+dx, y+dy)
+        self.settle(x, y)
+
+    def begin(self):
+        "Start batching edits: set_tile() only records them until the matching commit(). Batches may nest."
+        self.batch_depth += 1
+
+    def commit(self):
+        "Finish the current batch of edits; when the outermost batch finishes, apply them all at once."
+        self.batch_depth -= 1
+        if self.batch_depth or not self.batch_edits:
+            return
+        edits = self.batch_edits
+        self.batch_edits = {}
+        self.apply_edits(edits)
+
+    @contextlib.contextmanager
+    def batch(self):
+        "Context manager which batches all the set_tile() calls made inside it (see begin and commit)."
+        self.begin()
+        try:
+            yield self
+        finally:
+            self.commit()
+
+    def apply_edits(self, edits):
+        """
+        Internal. Apply a dict of locations to tiles (or None, to remove them), and update the bitmasks of everything around them in one pass.
+
+        This has the same effect as calling set_tile() for each edit, except where edits disagree about a shared corner, in which case filled corners win.
+        """
+        xs = [x for x, y in edits]
+        ys = [y for x, y in edits]
+        left, top = (min(xs) - 1, min(ys) - 1)
+        width, height = (max(xs) - left + 2, max(ys) - top + 2)
+
+        old_masks = self.bitmasks(left, top, width, height)
+        # neighbors outside the layer may be in another one, or nowhere
+        owners = {}
+        blocked = numpy.zeros((height, width), bool)
+        for x, y in self.outside(left, top, width, height):
+            if edits.has_key((x, y)):
+                continue
+            layer = self.owner(x, y)
+            if layer is None:
+                blocked[y - top, x - left] = True
+            elif layer is not self:
+                owners[(x, y)] = layer
+                tile = layer.stored_tile(x, y)
+                if tile:
+                    old_masks[y - top, x - left] = tile.bitmask
+        placed = numpy.zeros((height, width), bool)
+        placed_masks = numpy.zeros((height, width), numpy.uint8)
+        removed = numpy.zeros((height, width), bool)
+        for location, tile in edits.items():
+            x, y = location
+            if tile:
+                placed[y - top, x - left] = True
+                placed_masks[y - top, x - left] = tile.bitmask
+            elif self.stored_tile(x, y):
+                removed[y - top, x - left] = True
+
+        # every edit decides all four of its corners; other corners keep
+        # whatever bits their tiles already had
+        edited = placed | removed
+        decided = numpy.zeros((height + 1, width + 1), bool)
+        filled = numpy.zeros((height + 1, width + 1), bool)
+        for bit, row, column in CORNERS:
+            decided[row:row+height, column:column+width] |= edited
+            filled[row:row+height, column:column+width] |= placed & (placed_masks & bit > 0)
+        new_masks = numpy.zeros((height, width), numpy.uint8)
+        for bit, row, column in CORNERS:
+            corner_decided = decided[row:row+height, column:column+width]
+            corner_filled = filled[row:row+height, column:column+width]
+            new_masks |= numpy.where(corner_decided, corner_filled * bit, old_masks & bit).astype(numpy.uint8)
+
+        rows, columns = numpy.nonzero(edited | ((new_masks != old_masks) & ~blocked))
+        cells = zip((columns + left).tolist(), (rows + top).tolist(), new_masks[rows, columns].tolist(),
+                    placed[rows, columns].tolist(), removed[rows, columns].tolist())
+        for x, y, new_mask, is_placed, is_removed in cells:
+            layer = owners.get((x, y), self)
+            if is_placed:
+                tile = edits[(x, y)]
+                self.put_tile(x, y, tile)
+                if tile.bitmask != new_mask:
+                    tile.update(bitmask = new_mask)
+            elif is_removed:
+                # unsetting a tile, its neighbors were cleared above
+                tile = self.stored_tile(x, y)
+                tile.bitmask = 0
+                tile.kill = True
+                self.sync_tile(x, y, tile)
+                self.pending.add((x, y))
+            else:
+                neighbor = layer.stored_tile(x, y)
+                if not neighbor:
+                    # there isn't already a tile there; start one like
+                    # whichever placed tile gave it its corners
+                    template = None
+                    for dx, dy in ((-1, -1), (0, -1), (1, -1), (-1, 0), (1, 0), (-1, 1), (0, 1), (1, 1)):
+                        template = edits.get((x + dx, y + dy))
+                        if template:
+                            break
+                    neighbor = template.get_another(bitmask = 0)
+                # update the tile, remove if it disappeared
+                if neighbor.update(bitmask = new_mask) and not neighbor.bitmask:
+                    neighbor.update(health = 0)
+                else:
+                    layer.put_tile(x, y, neighbor)
+            layer.settle(x, y)
 
     def update(self):
         "Redraw tiles at any changed locations."
-        blank = pygame.Surface((TILE_SIZE, TILE_SIZE))
-        blank.fill(COLOR_KEY)
-        for location, tile in self.tiles.items():
-            if not (tile.dirty or tile.kill):
-                continue
-            self.dirty = True
+        if not self.pending:
+            return
+        pending = self.pending
+        self.pending = set()
+        for location in pending:
             x, y = location
+            tile = self.stored_tile(x, y)
+            if not tile or not (tile.dirty or tile.kill):
+                continue
+            self.redrawn.add(location)
             px_x = (x - self.left) * TILE_SIZE
             px_y = (y - self.top) * TILE_SIZE
-            self.surface.blit(blank, (px_x, px_y))
+            self.surface.fill(COLOR_KEY, (px_x, px_y, TILE_SIZE, TILE_SIZE))
             if tile.kill and not tile.flags.get("immortal"):
-                self.tiles.pop((x, y))
+                self.pop_tile(x, y)
             else:
-                # update its neighbors
-                self.set_tile(x, y, tile)
+                if self.settled.pop(location, None) != (tile.bitmask, tile.kill):
+                    # it changed by itself (or since it was settled), so
+                    # update its neighbors
+                    self.set_tile(x, y, tile)
                 self.surface.blit(tile.image, (px_x, px_y))
                 tile.dirty = False
+                self.sync_tile(x, y, tile)
 
     def fill(self, tile_type, *args):
         "Fill the layer with instances of a Tile callable, or None (clear it)."
@@ -313,19 +947,21 @@ class Layer(object):
     def set_row(self, y, tile_type, *args):
         "Fill a row with instances of a Tile callable, or None (clear it)."
         tile = None
-        for x in xrange(self.width):
-            if tile_type:
-                tile = tile_type(*args)
-            self.set_tile(x, y, tile)
+        with self.batch():
+            for x in xrange(self.width):
+                if tile_type:
+                    tile = tile_type(*args)
+                self.set_tile(x, y, tile)
         return self
 
     def set_column(self, x, tile_type, *args):
         "Fill a column with instances of a Tile callable, or None (clear it)."
         tile = None
-        for y in xrange(self.height):
-            if tile_type:
-                tile = tile_type(*args)
-            self.set_tile(x, y, tile)
+        with self.batch():
+            for y in xrange(self.height):
+                if tile_type:
+                    tile = tile_type(*args)
+                self.set_tile(x, y, tile)
         return self
 
     def set_rect(self, topleft, bottomright, tile_type, *args):
@@ -333,14 +969,314 @@ class Layer(object):
         left, top = topleft
         right, bottom = bottomright
         tile = None
-        for x in xrange(left, right):
-            for y in xrange(top, bottom):
-                if tile_type:
-                    tile = tile_type(*args)
-                self.set_tile(x, y, tile)
+        with self.batch():
+            for x in xrange(left, right):
+                for y in xrange(top, bottom):
+                    if tile_type:
+                        tile = tile_type(*args)
+                    self.set_tile(x, y, tile)
         return self
 
 
+class ArrayLayer(Layer):
+    """
+    A Layer which stores its tiles' type, bitmask, health and flags in NumPy arrays instead of keeping a Tile object per location. Same arguments as Layer.
+
+    get_tile() returns a Tile built from the arrays, and the same one while anything holds on to it; changes made through its update() go back into the arrays. Only the flags in FLAG_BITS are kept, and tiles must be within the layer's rect (plus the extra row and column set_tile() reaches).
+    """
+
+    def __init__(self, rect, tiles = None):
+        super(ArrayLayer, self).__init__(rect)
+        self.tiles = None
+        # tiles live in the arrays below
+        shape = (self.height + 1, self.width + 1)
+        self.types = numpy.zeros(shape, numpy.uint16)
+        # tile type ids (see tile_type_id), 0 where there's no tile
+        self.masks = numpy.zeros(shape, numpy.uint8)
+        self.health = numpy.zeros(shape, numpy.uint8)
+        self.flags = numpy.zeros(shape, numpy.uint8)
+        # FLAG_BITS, KILL_BIT and DIRTY_BIT
+        self.views = weakref.WeakValueDictionary()
+        # location to the Tile last handed out for it
+        if tiles:
+            for location, tile in tiles.items():
+                x, y = location
+                self.put_tile(x, y, tile)
+
+    def index(self, x, y):
+        "Internal. Return the array index of location x, y, or None if it's outside the arrays."
+        row, column = (y - self.top, x - self.left)
+        if 0 <= row <= self.height and 0 <= column <= self.width:
+            return (row, column)
+        return None
+
+    def count(self):
+        return int(numpy.count_nonzero(self.types))
+
+    def locations(self):
+        rows, columns = numpy.nonzero(self.types)
+        return zip((columns + self.left).tolist(), (rows + self.top).tolist())
+
+    def stored_tile(self, x, y):
+        tile = self.views.get((x, y))
+        if tile is not None:
+            return tile
+        index = self.index(x, y)
+        if index is None or not self.types[index]:
+            return None
+        tile_class, name = tile_types[self.types[index]]
+        bits = self.flags[index]
+        tile = tile_class(name = name, bitmask = int(self.masks[index]), health = int(self.health[index]), flags = flag_dict(bits))
+        tile.kill = bool(bits & KILL_BIT)
+        tile.dirty = bool(bits & DIRTY_BIT)
+        tile.layer = self
+        tile.location = (x, y)
+        self.views[(x, y)] = tile
+        return tile
+
+    def sync_tile(self, x, y, tile):
+        index = self.index(x, y)
+        self.types[index] = tile_type_id(tile.__class__, tile.name)
+        self.masks[index] = tile.bitmask
+        self.health[index] = tile.health
+        bits = flag_bits(tile.flags)
+        if tile.kill:
+            bits |= KILL_BIT
+        if tile.dirty:
+            bits |= DIRTY_BIT
+        self.flags[index] = bits
+
+    def to_arrays(self):
+        arrays = dict((field, getattr(self, field).copy()) for field, dtype in ARRAY_FIELDS)
+        arrays["flags"] &= ~numpy.uint8(KILL_BIT | DIRTY_BIT)
+        return arrays
+
+    @classmethod
+    def from_arrays(self, rect, arrays):
+        layer = self(rect)
+        for field, dtype in ARRAY_FIELDS:
+            getattr(layer, field)[:] = arrays[field]
+        # every tile still needs drawing
+        layer.flags[:] = numpy.where(layer.types, layer.flags | DIRTY_BIT, 0)
+        layer.pending.update(layer.locations())
+        return layer
+
+    def pop_tile(self, x, y):
+        index = self.index(x, y)
+        self.types[index] = self.masks[index] = self.health[index] = self.flags[index] = 0
+        tile = self.views.pop((x, y), None)
+        if tile is not None:
+            tile.layer = None
+        if self.on_edit:
+            self.on_edit(x, y)
+
+    def bitmasks(self, left, top, width, height):
+        masks = numpy.zeros((height, width), numpy.uint8)
+        # copy whatever part of the area overlaps the arrays
+        area_left, area_top = (max(left, self.left), max(top, self.top))
+        area_right = min(left + width, self.left + self.width + 1)
+        area_bottom = min(top + height, self.top + self.height + 1)
+        if area_left < area_right and area_top < area_bottom:
+            masks[area_top - top:area_bottom - top, area_left - left:area_right - left] = \
+                self.masks[area_top - self.top:area_bottom - self.top, area_left - self.left:area_right - self.left]
+        return masks
+
+    def put_tile(self, x, y, tile):
+        if self.index(x, y) is None:
+            raise IndexError("location {} is outside {}".format((x, y), self.rect))
+        old_tile = self.views.get((x, y))
+        if old_tile is not None and old_tile is not tile:
+            old_tile.layer = None
+        tile.layer = self
+        tile.location = (x, y)
+        self.views[(x, y)] = tile
+        self.sync_tile(x, y, tile)
+        if tile.dirty or tile.kill:
+            self.pending.add((x, y))
+        if self.on_edit:
+            self.on_edit(x, y)
+
+
+class Tileset(object):
+    """
+    Images for one kind of tile, sliced from its sheet. Takes a string name which should match the base name of a file in the tile images directory.
+
+    If the sheet has been packed into the tile atlas (see build_atlas.py), the images are sliced from that instead, using the rects in its index. Tilesets are shared between every tile with the same name, so don't modify their surfaces; use get_tileset() rather than making new ones.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        tile_sheet, variant_rects, health_rects = load_sheet(name)
+
+        self.variants = {}
+        for mask, rect in variant_rects.items():
+            self.variants[mask] = tile_sheet.subsurface(rect)
+
+        # double corners
+        nw_se = pygame.Surface((TILE_SIZE, TILE_SIZE))
+        nw_se.blit(self.variants[0b1000], (0, 0))
+        nw_se.blit(self.variants[0b0001], (0, 0))
+        self.variants[0b1001] = nw_se
+
+        ne_sw = pygame.Surface((TILE_SIZE, TILE_SIZE))
+        ne_sw.blit(self.variants[0b0100], (0, 0))
+        ne_sw.blit(self.variants[0b0010], (0, 0))
+        self.variants[0b0110] = ne_sw
+
+        blank = pygame.Surface((TILE_SIZE, TILE_SIZE))
+        blank.fill(COLOR_KEY)
+        self.variants[0] = blank
+
+        health_variants = []
+        variant_locations = dict((tuple(rect), mask) for mask, rect in variant_rects.items())
+        for rect in health_rects:
+            if rect is None:
+                health_variants.append(blank)
+            elif variant_locations.has_key(tuple(rect)):
+                # e.g. the dense center tile
+                health_variants.append(self.variants[variant_locations[tuple(rect)]])
+            else:
+                health_variants.append(tile_sheet.subsurface(rect))
+        self.health_variants = tuple(health_variants)
+
+    def __repr__(self):
+        return '<Tileset "{}">'.format(self.name)
+
+
+def get_tileset(name):
+    "Return the shared Tileset for the given tile name, loading it the first time it's asked for."
+    if not all_tilesets.has_key(name):
+        all_tilesets[name] = Tileset(name)
+    return all_tilesets[name]
+
+all_tilesets = {}
+
+
+def sheet_rects(left = 0, top = 0):
+    "Return the rects of a tile sheet's images, if its top left corner is at the pixel coordinates given: a dict of bitmasks to pygame.Rects, and a list of pygame.Rects for each health level (None where it's blank)."
+    variant_rects = {}
+    for mask, (column, row) in TILE_LOCATIONS.items():
+        variant_rects[mask] = pygame.Rect(left + column*TILE_SIZE, top + row*TILE_SIZE, TILE_SIZE, TILE_SIZE)
+    health_rects = []
+    for location in HEALTH_LOCATIONS:
+        if location is None:
+            health_rects.append(None)
+        else:
+            column, row = location
+            health_rects.append(pygame.Rect(left + column*TILE_SIZE, top + row*TILE_SIZE, TILE_SIZE, TILE_SIZE))
+    return variant_rects, health_rects
+
+def load_sheet(name):
+    "Internal. Return the pygame.Surface a Tileset's images are on, with the rects of those images (see sheet_rects): from the tile atlas if the named sheet is in it and hasn't changed since, or else from its own file."
+    index = load_atlas_index()
+    path = os.path.join(DATA_DIR, "images", "tiles", name + ".png")
+    entry = index["sheets"].get(name)
+    if entry and not getattr(sys, "frozen", None):
+        # the sheet may have been edited since the atlas was built; frozen
+        # builds can't tell, since unpacking them gives every file a new
+        # mtime, but they're built with a fresh atlas anyway
+        try:
+            if os.path.getmtime(path) != entry["mtime"]:
+                entry = None
+        except OSError:
+            pass
+    if entry:
+        variant_rects = dict((int(mask), pygame.Rect(rect)) for mask, rect in entry["variants"].items())
+        health_rects = [rect and pygame.Rect(rect) for rect in entry["health"]]
+        return atlas_page(entry["image"]), variant_rects, health_rects
+    tile_sheet = load_image(path)
+    variant_rects, health_rects = sheet_rects()
+    return tile_sheet, variant_rects, health_rects
+
+def load_image(path):
+    "Internal. Return the image in a file, converted for fast drawing if we can."
+    image = pygame.image.load(path)
+    if pygame.display.get_surface():
+        # we can only convert once there's a display mode set
+        image = image.convert_alpha()
+    return image
+
+def load_atlas_index():
+    "Internal. Return the tile atlas's index, reading it the first time; if the atlas hasn't been built, it has no sheets."
+    if not atlas_index:
+        try:
+            with open(os.path.join(ATLAS_DIR, ATLAS_INDEX)) as index_file:
+                index = json.load(index_file)
+            if index["version"] != ATLAS_VERSION or index["tile_size"] != TILE_SIZE:
+                raise ValueError("out of date")
+        except (IOError, KeyError, ValueError):
+            index = {"sheets": {}}
+        atlas_index.update(index)
+    return atlas_index
+
+def atlas_page(filename):
+    "Internal. Return one of the tile atlas's images, loading it the first time."
+    if not atlas_pages.has_key(filename):
+        atlas_pages[filename] = load_image(os.path.join(ATLAS_DIR, filename))
+    return atlas_pages[filename]
+
+atlas_index = {}
+atlas_pages = {}
+# atlas image filenames to their pygame.Surfaces
+
+
+def make_tile_mask(images):
+    "Internal. Returns a pygame.Surface for Chunk.get_tile_mask, from the walkable tile images under a location, bottom-up; None stands for an unwalkable tile."
+    if COLOR_KEY == (0, 0, 0):
+        new_color_key = (255, 255, 255)
+    else:
+        new_color_key = (0, 0, 0)
+    tile_mask = pygame.Surface((TILE_SIZE, TILE_SIZE))
+    tile_mask.set_colorkey(COLOR_KEY)
+    for image in images:
+        if image is None:
+            tile_mask.fill(COLOR_KEY)
+        else:
+            tile_mask.blit(image, (0,0))
+    # modified from source of pygame.surfarray.array_color_key
+    # which turned out to be easier than just using it
+    key_int = tile_mask.map_rgb(COLOR_KEY)
+    new_key_int = tile_mask.map_rgb(new_color_key)
+    mask_array = pygame.surfarray.pixels2d(tile_mask)
+    mask_array = numpy.choose(numpy.equal(mask_array, key_int), (key_int, new_key_int))
+    mask_array.shape = TILE_SIZE, TILE_SIZE
+    tile_mask = pygame.surfarray.make_surface(mask_array)
+    tile_mask.set_colorkey(COLOR_KEY)
+    return tile_mask
+
+walk_shapes = collections.OrderedDict()
+# tile images under a location (see Chunk.walk_shape) to their walkable area
+
+
+def tile_type_id(tile_class, name):
+    "Return the small integer id standing for tiles of the given class and name, giving them one if they don't have one yet."
+    key = (tile_class, name)
+    if not tile_type_ids.has_key(key):
+        tile_type_ids[key] = len(tile_types)
+        tile_types.append(key)
+    return tile_type_ids[key]
+
+tile_types = [None]
+# tile type id to (tile class, name); 0 means no tile
+tile_type_ids = {}
+
+def flag_bits(flags):
+    "Return a tile's flags dict as FLAG_BITS."
+    bits = 0
+    for flag, bit in FLAG_BITS.items():
+        if flags.get(flag):
+            bits |= bit
+    return bits
+
+def flag_dict(bits):
+    "Return a tile flags dict from FLAG_BITS."
+    return flag_dicts[bits & FLAG_MASK].copy()
+
+FLAG_MASK = sum(FLAG_BITS.values())
+flag_dicts = [dict((flag, bool(bits & bit)) for flag, bit in FLAG_BITS.items()) for bits in xrange(FLAG_MASK + 1)]
+# every combination of FLAG_BITS as a dict, for flag_dict to copy
+
+
 class Tile(object):
     "Generic class for map tile information. Takes a string name which should match the base name of a file in the tile images directory."
 
@@ -363,72 +1299,21 @@ class Tile(object):
         # if True, remove this tile from its layer
         self.dirty = True
         # if True, redraw this tile onto its layer
+        self.layer = None
+        self.location = None
+        # where this tile is stored, so changes can be reported to its layer
 
-        tile_sheet = pygame.image.load(os.path.join(DATA_DIR, "images", "tiles", name + ".png"))
-        tile_locations = {}
-
-        # center
-        tile_locations[0b1111] = (1, 3)
-
-        # corner
-        tile_locations[0b0001] = (0, 2)
-        tile_locations[0b0010] = (2, 2)
-        tile_locations[0b0100] = (0, 4)
-        tile_locations[0b1000] = (2, 4)
-        
-        # anticorner
-        tile_locations[0b1110] = (1, 0)
-        tile_locations[0b1101] = (2, 0)
-        tile_locations[0b1011] = (1, 1)
-        tile_locations[0b0111] = (2, 1)
-
-        # edge
-        tile_locations[0b0011] = (1, 2)
-        tile_locations[0b1010] = (2, 3)
-        tile_locations[0b0101] = (0, 3)
-        tile_locations[0b1100] = (1, 4)
-
-
-        self.variants = {}
-        cursor = pygame.Rect(0, 0, TILE_SIZE, TILE_SIZE)
-        for mask, location in tile_locations.items():
-            x, y = location
-            x *= TILE_SIZE
-            y *= TILE_SIZE
-            cursor.topleft = (x, y)
-            self.variants[mask] = tile_sheet.subsurface(cursor)
-
-        # double corners
-        nw_se = pygame.Surface((TILE_SIZE, TILE_SIZE))
-        nw_se.blit(self.variants[0b1000], (0, 0))
-        nw_se.blit(self.variants[0b0001], (0, 0))
-        self.variants[0b1001] = nw_se
-
-        ne_sw = pygame.Surface((TILE_SIZE, TILE_SIZE))
-        ne_sw.blit(self.variants[0b0100], (0, 0))
-        ne_sw.blit(self.variants[0b0010], (0, 0))
-        self.variants[0b0110] = ne_sw
+        self.tileset = get_tileset(name)
 
-        blank = pygame.Surface((TILE_SIZE, TILE_SIZE))
-        blank.fill(COLOR_KEY)
-        self.variants[0] = blank
+    @property
+    def variants(self):
+        "Shared dict of bitmask to pygame.Surface for this tile's name."
+        return self.tileset.variants
 
-        self.health_variants = []
-        self.health_variants.append(blank)
-        # these are small, non-connecting (0b0000)
-        cursor.topleft = (0, TILE_SIZE)
-        self.health_variants.append(tile_sheet.subsurface(cursor))
-        cursor.topleft = (0, 0)
-        self.health_variants.append(tile_sheet.subsurface(cursor))
-
-        # these are dense and fully connecting (0b1111)
-        self.health_variants.append(self.variants[0b1111])
-        cursor.topleft = (2*TILE_SIZE, 5*TILE_SIZE)
-        self.health_variants.append(tile_sheet.subsurface(cursor))
-        cursor.topleft = (TILE_SIZE, 5*TILE_SIZE)
-        self.health_variants.append(tile_sheet.subsurface(cursor))
-        cursor.topleft = (0, 5*TILE_SIZE)
-        self.health_variants.append(tile_sheet.subsurface(cursor))
+    @property
+    def health_variants(self):
+        "Shared sequence of pygame.Surfaces indexed by health, for unconnected and fully connected tiles."
+        return self.tileset.health_variants
 
     def __repr__(self):
         return '<{} tile ("{}")>'.format(self.__class__.__name__, self.name)
@@ -456,6 +1341,9 @@ class Tile(object):
 
         if bitmask is not None:
             self.bitmask = bitmask
+            if self.bitmask:
+                # a tile being removed is needed again after all
+                self.kill = False
             if self.bitmask == 0b1111:
                 self.health = max(self.health, 3)
             else:
@@ -480,30 +1368,39 @@ class Tile(object):
             return False
         else:
             self.dirty = True
+            if self.layer:
+                x, y = self.location
+                self.layer.changed(x, y)
             return True
 
     @property
     def image(self):
         "Returns the tile's current image, defined by its bitmask and health."
-        font = pygame.font.Font(os.path.join(DATA_DIR, "fonts", "04B_11__.TTF"), 8)
         color = (250, 200, 200)
 
-        # these blit useful debug data on top of tiles
+        # these blit useful debug data on top of (a copy of) tiles;
+        # the tileset's own images are shared, so don't draw on those
 
-        def debug_bitmask(name=None):
+        def debug_bitmask(image, name=None):
             if not name or self.name == name:
+                font = fonts.get_font("04B_11__.TTF", 8)
                 string_mask = "{:04b}".format(self.bitmask)
-                line1 = font.render(string_mask[:2], False, color)
-                line2 = font.render(string_mask[2:], False, color)
+                line1 = fonts.render(font, string_mask[:2], color)
+                line2 = fonts.render(font, string_mask[2:], color)
+                image = image.copy()
                 image.blit(line1, (14, 6))
                 image.blit(line2, (14, 16))
+            return image
 
-        def debug_health(name=None):
+        def debug_health(image, name=None):
             if not name or self.name == name:
-                health_text = font.render(str(self.health), False, color)
-                index_text = font.render(str(health_index), False, color)
+                font = fonts.get_font("04B_11__.TTF", 8)
+                health_text = fonts.render(font, str(self.health), color)
+                index_text = fonts.render(font, str(health_index), color)
+                image = image.copy()
                 image.blit(health_text, (14, 6))
                 image.blit(index_text, (14, 16))
+            return image
 
         if self.bitmask == 0b1111 or self.bitmask == 0b0000:
             health_index = min(int(math.floor(self.health)), len(self.health_variants)-1)
@@ -512,7 +1409,7 @@ class Tile(object):
             image = self.variants[self.bitmask]
             health_index = "-" # for debug printing
 
-        # put debug calls here
+        # put debug calls here, e.g. image = debug_bitmask(image)
 
         return image
 
@@ -661,10 +1558,13 @@ class DirtTile(FactoryTile):
     def __init__(self, *args, **kwargs):
         kwargs["name"] = "dirt"
         super(DirtTile, self).__init__(*args, **kwargs)
-        self.health_variants.pop(6)
-        # this one is too conspicuous
         self.health_max -= 1
-        # because we have one fewer tile for it
+        # because we have one fewer tile for it (see health_variants)
+
+    @property
+    def health_variants(self):
+        # the last one is too conspicuous
+        return self.tileset.health_variants[:6]
 
     def item(self):
         return DirtItem()